@@ -1,11 +1,38 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import mmap
 import os
+import queue
 import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import aclosing, contextmanager
 from difflib import SequenceMatcher
+from functools import partial
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import parse_qsl, urlsplit
+import requests
 import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from spotipy.oauth2 import SpotifyOAuth
 from flask import Flask, redirect, request, session, url_for, render_template_string
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:  # Optional, only needed for MATCHER_BACKEND=numpy
+    np = None
+
 # --- FLASK APP AND SESSION SETUP ---
 app = Flask(__name__, static_folder='.', static_url_path='/static')
 # Load .env file for local development (Vercel will use its own env vars)
@@ -21,6 +48,97 @@ CLIENT_ID = os.environ.get("CLIENT_ID")
 CLIENT_SECRET = os.environ.get("CLIENT_SECRET")
 REDIRECT_URI = os.environ.get("REDIRECT_URI") # Should be https://.../callback
 SCOPE = "user-library-read playlist-read-private playlist-read-collaborative playlist-modify-private playlist-modify-public"
+# Point these at a local stand-in (see fake_spotify.py) to run without a live Spotify account.
+SPOTIFY_API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1/")
+SPOTIFY_ACCOUNTS_URL = os.environ.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+# Set to a file path to record every Spotify request/response as fixtures fake_spotify.py can replay.
+SPOTIFY_RECORD_PATH = os.environ.get("SPOTIFY_RECORD_PATH")
+
+# --- SHARED HTTP SESSION SETUP ---
+# Connections kept open per host. Should cover FETCH_MAX_WORKERS times the number of
+# requests the server handles at once, or extra connections get opened and thrown away.
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "32"))
+# Spotify GET responses that carry an ETag are kept and revalidated with If-None-Match, so an
+# unchanged page comes back as an empty 304 (see SpotifySession). The cache is bounded by the
+# total size of the bodies it holds (0 turns it off). Set HTTP_CACHE_PATH to a SQLite file to keep it on disk.
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", "50000000"))
+HTTP_CACHE_PATH = os.environ.get("HTTP_CACHE_PATH")
+
+# --- RATE LIMIT SETUP ---
+# Every Spotify request goes through RATE_LIMITER (see RateLimitScheduler).
+# Optional requests per second (and burst size) for the whole process and for each user; 0 turns a
+# cap off. Both are off by default: the adaptive concurrency limit and Retry-After pauses below
+# follow Spotify's actual limit, and a fixed cap would only slow runs down before any 429.
+RATE_LIMIT_GLOBAL_RPS = float(os.environ.get("RATE_LIMIT_GLOBAL_RPS", "0"))
+RATE_LIMIT_GLOBAL_BURST = int(os.environ.get("RATE_LIMIT_GLOBAL_BURST", "40"))
+RATE_LIMIT_USER_RPS = float(os.environ.get("RATE_LIMIT_USER_RPS", "0"))
+RATE_LIMIT_USER_BURST = int(os.environ.get("RATE_LIMIT_USER_BURST", "20"))
+# Requests in flight start at the initial limit and adapt between 1 and the max.
+RATE_LIMIT_INITIAL_CONCURRENCY = int(os.environ.get("RATE_LIMIT_INITIAL_CONCURRENCY", "8"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.environ.get("RATE_LIMIT_MAX_CONCURRENCY", str(HTTP_POOL_SIZE)))
+# A 429 is retried after its Retry-After, unless Spotify asks us to wait longer than this.
+RATE_LIMIT_MAX_RETRY_AFTER = float(os.environ.get("RATE_LIMIT_MAX_RETRY_AFTER", "30"))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "5"))
+
+
+# --- API FETCH SETUP ---
+# Max number of page requests in flight at once for a single paged fetch.
+# RATE_LIMITER still decides how many of them actually go out at the same time.
+FETCH_MAX_WORKERS = int(os.environ.get("FETCH_MAX_WORKERS", "32"))
+# Track fields requested from playlists (`total` lets us fetch pages in parallel).
+# The target is fetched with a market, so it also carries availability and relinking info.
+TARGET_TRACK_FIELDS = "items(track(id,name,duration_ms,artists(id,name),external_ids,is_playable,is_local,linked_from(id))),next,total"
+FILTER_TRACK_FIELDS = "items(track(id,name,duration_ms,artists(id,name),external_ids)),next,total"
+
+# --- PLAYLIST CACHE SETUP ---
+# Set PLAYLIST_CACHE_PATH to a SQLite file (e.g. /tmp/playlist-cache.db on Vercel) to keep
+# cached playlists on disk. Without it they're cached in memory, which is fine for local dev.
+PLAYLIST_CACHE_PATH = os.environ.get("PLAYLIST_CACHE_PATH")
+# The cache is bounded by the total number of tracks it holds, least recently used go first.
+PLAYLIST_CACHE_MAX_TRACKS = int(os.environ.get("PLAYLIST_CACHE_MAX_TRACKS", "200000"))
+
+# --- AVAILABILITY CACHE SETUP ---
+# Whether a track is playable in a market is remembered for every user in that market
+# (see AVAILABILITY_CACHE). Seconds an answer is trusted before the track is checked again.
+AVAILABILITY_TTL = float(os.environ.get("AVAILABILITY_TTL", "21600"))
+# Max number of (track, market) answers kept, least recently used go first.
+AVAILABILITY_CACHE_MAX_ENTRIES = int(os.environ.get("AVAILABILITY_CACHE_MAX_ENTRIES", "500000"))
+
+# --- LIBRARY MIRROR SETUP ---
+# Set LIBRARY_MIRROR_PATH to a SQLite file to keep a local copy of each user's playlists,
+# playlist items and Liked Songs (see LibraryMirror). Pages then read from it, and only
+# playlists whose snapshot_id changed are downloaded again. Takes over from PLAYLIST_CACHE.
+LIBRARY_MIRROR_PATH = os.environ.get("LIBRARY_MIRROR_PATH")
+# Seconds a user's playlist list (and so each playlist's snapshot_id) is trusted before it's listed again.
+LIBRARY_MIRROR_TTL = float(os.environ.get("LIBRARY_MIRROR_TTL", "60"))
+
+# --- MATCHER SETUP ---
+# "python" scores candidates one pair at a time. "numpy" (needs numpy installed) scores
+# all of a target's candidates in one vectorized step, which pays off on big filter libraries.
+MATCHER_BACKEND = os.environ.get("MATCHER_BACKEND", "python")
+# Worker processes the matcher spreads target tracks over (0 or 1 keeps it in the request thread).
+# Each worker gets the filter index once, when it starts.
+MATCHER_PROCESSES = int(os.environ.get("MATCHER_PROCESSES", "0"))
+# Target tracks (or title groups) per task handed to a worker process.
+MATCHER_CHUNK_SIZE = 250
+
+# --- FILTER INDEX SETUP ---
+# Set FILTER_INDEX_DIR to a directory to keep each built filter index on disk, keyed by its
+# sources' snapshot_ids. A later run over the same sources opens it through mmap instead of
+# building it again, and worker processes share its pages (see MappedFilterIndex).
+FILTER_INDEX_DIR = os.environ.get("FILTER_INDEX_DIR")
+# Index files kept in FILTER_INDEX_DIR, least recently used go first.
+FILTER_INDEX_MAX_FILES = int(os.environ.get("FILTER_INDEX_MAX_FILES", "50"))
+
+# --- TITLE CACHE SETUP ---
+# Normalized titles are cached per process, since popular titles show up in everyone's library.
+TITLE_CACHE_MAX_ENTRIES = int(os.environ.get("TITLE_CACHE_MAX_ENTRIES", "200000"))
+# Optional JSON file the title cache is loaded from at startup and saved to after runs that added to it,
+# so a cold start doesn't begin empty (e.g. /tmp/title-cache.json, or a file shipped with the app).
+TITLE_CACHE_PATH = os.environ.get("TITLE_CACHE_PATH")
+# Writing the file out costs far more than the titles it saves, so it's written at most once per this
+# many seconds (and when the process exits). Titles added in between go out with the next save.
+TITLE_CACHE_SAVE_INTERVAL = float(os.environ.get("TITLE_CACHE_SAVE_INTERVAL", "300"))
 
 # --- LOGO IMAGE (for use in templates) ---
 LOGO_IMG = '<img src="/static/spotify.png" alt="Spotify Filterer" width="40" height="40">'
@@ -28,13 +146,17 @@ LOGO_IMG = '<img src="/static/spotify.png" alt="Spotify Filterer" width="40" hei
 
 def get_oauth_manager():
     """Returns a SpotifyOAuth object that uses the user's session for caching."""
-    return SpotifyOAuth(
+    oauth_manager = SpotifyOAuth(
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
         redirect_uri=REDIRECT_URI,
         scope=SCOPE,
-        cache_handler=spotipy.cache_handler.FlaskSessionCacheHandler(session)
+        cache_handler=spotipy.cache_handler.FlaskSessionCacheHandler(session),
+        requests_session=HTTP_SESSION
     )
+    oauth_manager.OAUTH_AUTHORIZE_URL = f"{SPOTIFY_ACCOUNTS_URL}/authorize"
+    oauth_manager.OAUTH_TOKEN_URL = f"{SPOTIFY_ACCOUNTS_URL}/api/token"
+    return oauth_manager
 
 def get_spotify_client():
     """Gets a Spotipy client for the current user, or None if not authenticated."""
@@ -48,7 +170,9 @@ def get_spotify_client():
         token_info = oauth_manager.refresh_access_token(token_info['refresh_token'])
         session['token_info'] = token_info
 
-    return spotipy.Spotify(auth=token_info['access_token'])
+    sp = spotipy.Spotify(auth=token_info['access_token'], requests_session=HTTP_SESSION)
+    sp.prefix = SPOTIFY_API_URL
+    return sp
 
 
 # --- PAGE ROUTES ---
@@ -68,26 +192,25 @@ def index():
     # User is logged in, show the main app
     user_info = sp.current_user()
     
-    # Fetch all user playlists to display in the filter list
+    # Fetch all user playlists to display in the filter list.
+    # The list endpoint already has everything the grid shows, so no per-playlist lookups.
     print("Fetching user's playlists...")
     playlists = []
-    offset = 0
-    limit = 50
-    while True:
-        results = sp.current_user_playlists(limit=limit, offset=offset)
-        if not results['items']:
-            break
-        
-        full_playlist_items = []
-        for item in results['items']:
+    if LIBRARY_MIRROR is not None:
+        # Read from the mirror, which lists them from the API at most every LIBRARY_MIRROR_TTL seconds
+        LIBRARY_MIRROR.sync_playlists(sp, user_info['id'])
+        playlists = LIBRARY_MIRROR.playlists(user_info['id'])
+    else:
+        for item in fetch_all_pages(sp.current_user_playlists, limit=50):
             try:
-                pl = sp.playlist(item['id'], fields="id,name,images,tracks.total")
-                full_playlist_items.append(pl)
+                playlists.append({
+                    'id': item['id'],
+                    'name': item['name'],
+                    'images': item.get('images') or [],
+                    'tracks': {'total': item['tracks']['total']},
+                })
             except Exception:
-                pass 
-                
-        playlists.extend(full_playlist_items)
-        offset += limit
+                pass
     
     print(f"Found {len(playlists)} playlists.")
     
@@ -161,29 +284,20 @@ def run_filter():
                 results=None
             )
         
-        playlist_name = sp.playlist(target_playlist_id, fields='name')['name']
+        target_playlist = sp.playlist(target_playlist_id, fields='name,snapshot_id')
+        playlist_name = target_playlist['name']
 
-        # 3. Fetch target playlist tracks with full details
-        target_tracks = []
+        # 3. Fetch target playlist tracks with full details, in the user's market
+        # so the same sweep also tells us which tracks are playable.
+        # An unchanged target is reused from the cache, re-checking only stale availability.
+        user_info = sp.current_user()
+        user_market = user_info.get('country', 'US')
+        target_tracks = fetch_target_tracks(sp, target_playlist_id, user_market, target_playlist.get('snapshot_id'))
         seven_rings_in_fetch = []  # Debug
-        offset = 0
-        while True:
-            results = sp.playlist_items(
-                target_playlist_id, 
-                limit=100, 
-                offset=offset,
-                fields="items(track(id,name,duration_ms,artists(id,name),external_ids,is_playable,is_local)),next"
-            )
-            if not results['items']:
-                break
-            for item in results['items']:
-                track = item.get('track')
-                if track and track.get('id'):
-                    target_tracks.append(track)
-                    # Debug: track all 7 rings during fetch
-                    if track.get('name') and '7 rings' in track.get('name', '').lower():
-                        seven_rings_in_fetch.append(f"Fetched at offset {offset}: '{track['name']}' ID={track['id']}")
-            offset += 100
+        for position, track in enumerate(target_tracks):
+            # Debug: track all 7 rings during fetch
+            if track.get('name') and '7 rings' in track.get('name', '').lower():
+                seven_rings_in_fetch.append(f"Fetched at position {position}: '{track['name']}' ID={track['id']}")
         
         # Count how many times each track ID appears in target playlist
         target_id_counts = {}
@@ -191,32 +305,13 @@ def run_filter():
             tid = track['id']
             target_id_counts[tid] = target_id_counts.get(tid, 0) + 1
 
-        # 4. Check track availability (need market parameter for this)
-        # Get user's market
-        user_info = sp.current_user()
-        user_market = user_info.get('country', 'US')
-        
-        # Build a set of unavailable track IDs by checking with market parameter
+        # 4. Check track availability from the market-aware fetch
         unavailable_ids = set()
-        offset = 0
-        while True:
-            results = sp.playlist_items(
-                target_playlist_id, 
-                limit=100, 
-                offset=offset,
-                fields="items(track(id,is_playable,is_local)),next",
-                market=user_market
-            )
-            if not results['items']:
-                break
-            for item in results['items']:
-                track = item.get('track')
-                if track and track.get('id'):
-                    is_local = track.get('is_local', False)
-                    is_playable = track.get('is_playable', True)
-                    if is_local or not is_playable:
-                        unavailable_ids.add(track['id'])
-            offset += 100
+        for track in target_tracks:
+            is_local = track.get('is_local', False)
+            is_playable = track.get('is_playable', True)
+            if is_local or not is_playable:
+                unavailable_ids.add(track['id'])
         
         # Separate tracks based on availability
         unavailable_tracks = []
@@ -231,50 +326,27 @@ def run_filter():
             else:
                 available_target_tracks.append(track)
 
-        # 5. Build the filter tracks list with full details
-        all_filter_tracks = []
-        all_filter_song_ids = set()
-
-        if include_liked_songs:
-            offset = 0
-            while True:
-                results = sp.current_user_saved_tracks(limit=50, offset=offset)
-                if not results['items']:
-                    break
-                for item in results['items']:
-                    track = item.get('track')
-                    if track and track.get('id'):
-                        all_filter_tracks.append(track)
-                        all_filter_song_ids.add(track['id'])
-                offset += 50
-        
-        for filter_pid in filter_playlist_ids:
-            if filter_pid == "liked_songs":
-                continue
-            
-            offset = 0
-            while True:
-                results = sp.playlist_items(
-                    filter_pid, 
-                    limit=100, 
-                    offset=offset, 
-                    fields="items(track(id,name,duration_ms,artists(id,name),external_ids)),next"
-                )
-                if not results['items']:
-                    break
-                for item in results['items']:
-                    track = item.get('track')
-                    if track and track.get('id'):
-                        all_filter_tracks.append(track)
-                        all_filter_song_ids.add(track['id'])
-                offset += 100
+        # 5. Build the filter corpus: one compact copy of each track, however many sources have it
+        # All sources are fetched concurrently. The corpus orders tracks by where they first appear
+        # in selection order, so the matcher's tie-breaking doesn't depend on fetch timing.
+        filter_corpus = FilterCorpus()
+        for source_index, source_tracks, version in fetch_filter_sources(sp, user_info['id'], include_liked_songs, filter_playlist_ids):
+            filter_corpus.add_source(source_index, source_tracks, version)
+        all_filter_tracks = filter_corpus.tracks()
 
         # 6. Find exact ID matches - but keep ALL tracks for fuzzy matching
         exact_matches = []
         exact_match_ids = set()
+        if LIBRARY_MIRROR is not None:
+            # The filter sources are all in the mirror, so this is a single join there
+            filter_ids_in_target = LIBRARY_MIRROR.exact_matches(
+                user_info['id'], include_liked_songs, filter_playlist_ids, [t['id'] for t in available_target_tracks]
+            )
+        else:
+            filter_ids_in_target = filter_corpus
         
         for track in available_target_tracks:
-            if track['id'] in all_filter_song_ids:
+            if track['id'] in filter_ids_in_target:
                 if track['id'] not in exact_match_ids:
                     exact_matches.append({'track': track, 'reason': 'Exact match in filter playlist'})
                     exact_match_ids.add(track['id'])
@@ -291,13 +363,46 @@ def run_filter():
         # This will catch different versions of the same song (different IDs but same title/artist)
         # Exclude tracks that already had exact matches
         tracks_for_fuzzy = [t for t in target_unique if t['id'] not in exact_match_ids]
-        fuzzy_duplicates, cross_warnings = find_duplicates_and_warnings(tracks_for_fuzzy, all_filter_tracks)
+        matcher_stats = Counter()
+        # Unchanged filter sources reuse the filter index saved by an earlier run
+        filter_index = None
+        filter_index_file = None
+        if FILTER_INDEX_DIR and filter_corpus.version():
+            filter_index_file = filter_index_path(filter_corpus.version())
+            filter_index = open_filter_index(filter_index_file)
+        matcher_stats['filter_index_mapped'] = int(filter_index is not None)
+        # Fill in missing ISRCs first, so more of them are settled by the ISRC join than by fuzzy matching.
+        # A saved filter index already has the ISRCs its tracks were backfilled with.
+        backfill_tracks = tracks_for_fuzzy + (all_filter_tracks if filter_index is None else [])
+        isrc_matches = None
+        if LIBRARY_MIRROR is not None:
+            backfilled = LIBRARY_MIRROR.backfill_isrcs(sp, backfill_tracks)
+            isrc_matches = LIBRARY_MIRROR.isrc_matches(user_info['id'], include_liked_songs, filter_playlist_ids, tracks_for_fuzzy)
+        else:
+            backfilled = backfill_isrcs(sp, backfill_tracks)
+        matcher_stats['isrcs_backfilled'] = len(backfilled)
+        if filter_index is None:
+            filter_index = build_filter_index(all_filter_tracks)
+            if filter_index_file:
+                save_filter_index(filter_index, filter_index_file)
+        fuzzy_duplicates, cross_warnings = find_duplicates_and_warnings(
+            tracks_for_fuzzy, all_filter_tracks, filter_index=filter_index, stats=matcher_stats, isrc_matches=isrc_matches
+        )
         
         fuzzy_dup_ids = {d[0]['id'] for d in fuzzy_duplicates}
         remaining_after_fuzzy = [t for t in tracks_for_fuzzy if t['id'] not in fuzzy_dup_ids]
 
         # 9. Find internal duplicates within the target playlist
-        internal_duplicates = find_internal_duplicates(remaining_after_fuzzy)
+        internal_duplicates = find_internal_duplicates(remaining_after_fuzzy, stats=matcher_stats)
+        matcher_stats['title_cache_hits (process)'] = TITLE_CACHE.hits
+        matcher_stats['title_cache_misses (process)'] = TITLE_CACHE.misses
+        conditional = HTTP_SESSION.cache_stats['conditional']
+        not_modified = HTTP_SESSION.cache_stats['not_modified']
+        matcher_stats['http_conditional_requests (process)'] = conditional
+        matcher_stats['http_not_modified (process)'] = not_modified
+        matcher_stats['http_not_modified_ratio (process)'] = round(not_modified / conditional, 2) if conditional else 0
+        if TITLE_CACHE_PATH:
+            save_title_cache(TITLE_CACHE_PATH)
 
         # 10. Compile all tracks to remove (unique IDs only)
         tracks_to_remove_ids = set()
@@ -374,7 +479,7 @@ def run_filter():
         # Check what 7 rings versions exist in filter
         for track in all_filter_tracks:
             if '7 rings' in track.get('name', '').lower():
-                seven_rings_debug.append(f"Filter: '{track['name']}' ID={track['id']}, duration={track.get('duration_ms')}ms")
+                seven_rings_debug.append(f"Filter: '{track['name']}' ID={track['id']}, duration={track.get('duration_ms')}ms, sources={filter_corpus.sources[track['id']]}")
         
         # Check if the non-exact 7 rings was in fuzzy matching input
         for track in tracks_for_fuzzy:
@@ -396,25 +501,22 @@ def run_filter():
                     removal_log.append(f"Batch {i//100 + 1}: FAILED - {str(e)}")
                     failed_removals.extend(batch)
         
+        if LIBRARY_MIRROR is not None and actual_removals:
+            # The target's snapshot_id changed, so list the playlists again next time
+            LIBRARY_MIRROR.expire_playlists(user_info['id'])
+        
         # After removal, verify a sample of tracks are actually gone
         verification_results = []
         sample_tracks = list(tracks_to_remove_ids)[:5]  # Check first 5
         
         # Re-fetch the playlist to verify
         post_removal_ids = set()
-        offset = 0
-        while True:
-            results = sp.playlist_items(target_playlist_id, limit=100, offset=offset, fields="items(track(id,name)),next")
-            if not results['items']:
-                break
-            for item in results['items']:
-                track = item.get('track')
-                if track and track.get('id'):
-                    post_removal_ids.add(track['id'])
-                    # Check for 7 rings after removal
-                    if '7 rings' in track.get('name', '').lower():
-                        seven_rings_debug.append(f"AFTER REMOVAL: '7 rings' still exists with ID={track['id']}")
-            offset += 100
+        post_removal_tracks = fetch_playlist_tracks(sp, target_playlist_id, fields="items(track(id,name)),next,total")
+        for track in post_removal_tracks:
+            post_removal_ids.add(track['id'])
+            # Check for 7 rings after removal
+            if '7 rings' in track.get('name', '').lower():
+                seven_rings_debug.append(f"AFTER REMOVAL: '7 rings' still exists with ID={track['id']}")
         
         for tid in sample_tracks:
             still_exists = tid in post_removal_ids
@@ -457,6 +559,7 @@ def run_filter():
             'warnings': warnings_for_template,
             'warnings_total': len(cross_warnings_sorted),
             'debug_log': removal_log,
+            'matcher_stats': [f"{name}: {count}" for name, count in sorted(matcher_stats.items())],
             'verification': verification_results,
             'post_removal_count': len(post_removal_ids),
             'seven_rings_debug': seven_rings_debug
@@ -507,72 +610,1371 @@ def get_playlist_id_from_link(link):
         return None
 
 
+# --- CACHE BACKENDS ---
+
+class MemoryCache:
+    """
+    In-memory LRU cache for JSON-style values.
+    Bounded by the total weight of its entries (e.g. the number of tracks stored).
+    """
+
+    def __init__(self, max_weight):
+        self.max_weight = max_weight
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, weight)
+        self._total_weight = 0
+        self._lock = threading.Lock()
+        # A process forked while another thread held the lock would otherwise start with it locked
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None if it isn't cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def items(self):
+        """(key, value) of every entry, least recently used first."""
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._entries.items()]
+
+    def set(self, key, value, weight=1):
+        """Stores a value, evicting the least recently used entries if over the limit."""
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_weight -= old[1]
+            self._entries[key] = (value, weight)
+            self._total_weight += weight
+            while self._total_weight > self.max_weight and len(self._entries) > 1:
+                _, (_, evicted_weight) = self._entries.popitem(last=False)
+                self._total_weight -= evicted_weight
+
+
+def connect_sqlite(path):
+    """Opens a connection to a SQLite file. A fresh connection per call keeps its users safe to call from any thread."""
+    return sqlite3.connect(path, timeout=30)
+
+
+class SqliteCache:
+    """
+    LRU cache for JSON-style values stored in a SQLite file.
+    Survives restarts and is shared by every worker process pointing at the same file.
+    """
+
+    def __init__(self, path, max_weight):
+        self.path = path
+        self.max_weight = max_weight
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " weight INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+
+    def _connect(self):
+        return connect_sqlite(self.path)
+
+    def get(self, key):
+        """Returns the cached value, or None if it isn't cached."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, value, weight=1):
+        """Stores a value, evicting the least recently used entries if over the limit."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, weight, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), weight, time.time())
+            )
+            # Keep the most recently used entries that fit in max_weight (always keep the newest one)
+            conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM ("
+                "  SELECT key, SUM(weight) OVER (ORDER BY last_used DESC, key) AS running,"
+                "  ROW_NUMBER() OVER (ORDER BY last_used DESC, key) AS rank FROM cache)"
+                " WHERE running > ? AND rank > 1)",
+                (self.max_weight,)
+            )
+
+
+@contextmanager
+def atomic_file(path, mode='w'):
+    """
+    Opens a temp file next to `path` and moves it over `path` once the block finishes, so readers
+    only ever see a complete file. Each writer gets its own temp file, even threads of one process.
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def make_cache(path, max_weight):
+    """Returns a SQLite-backed cache if a path is configured, otherwise an in-memory one."""
+    if path:
+        return SqliteCache(path, max_weight)
+    return MemoryCache(max_weight)
+
+
+# Playlist contents keyed by (playlist_id, snapshot_id, fields). A playlist's snapshot_id
+# changes whenever it's edited, so an unchanged playlist never needs to be re-downloaded.
+# Also holds each user's Liked Songs mirror (see sync_liked_songs).
+PLAYLIST_CACHE = make_cache(PLAYLIST_CACHE_PATH, PLAYLIST_CACHE_MAX_TRACKS)
+
+# Track availability keyed by "market:track_id" -> (is_playable, checked_at). It doesn't depend on
+# who's asking, so it's shared by every user in the process. Kept in memory: it's read and
+# written one track at a time, which would mean a SQLite round trip per track.
+AVAILABILITY_CACHE = MemoryCache(AVAILABILITY_CACHE_MAX_ENTRIES)
+
+
+# --- SPOTIFY HTTP LAYER ---
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `capacity`. Not locked, the scheduler holds the lock."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimitScheduler:
+    """
+    Gate that every Spotify request goes through.
+
+    - Optionally, a global token bucket and one bucket per user cap the request rate (a rate of 0 turns one off).
+    - Requests in flight are capped by an adaptive limit: halved on every 429,
+      raised by one after a full window of successful requests.
+    - A 429 pauses all requests for its Retry-After, then the request is retried.
+      Longer than max_retry_after, the 429 is returned and the pause is cut to max_retry_after.
+    """
+
+    def __init__(self, global_rate, global_burst, user_rate, user_burst,
+                 initial_concurrency, max_concurrency, max_retry_after, max_retries, max_users=1000):
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_users = max_users
+        self.user_buckets = OrderedDict()  # user_key -> TokenBucket, least recently used first
+        self.concurrency_limit = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retry_after = max_retry_after
+        self.max_retries = max_retries
+        self.stats = {'requests': 0, 'rate_limited': 0, 'retried': 0}
+        self._in_flight = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _user_bucket(self, user_key):
+        bucket = self.user_buckets.get(user_key)
+        if bucket is None:
+            bucket = self.user_buckets[user_key] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self.user_buckets) > self.max_users:
+                self.user_buckets.popitem(last=False)
+        else:
+            self.user_buckets.move_to_end(user_key)
+        return bucket
+
+    def _acquire(self, user_key):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._in_flight >= self.concurrency_limit:
+                        wait = None  # Until a request finishes
+                    else:
+                        user_bucket = self._user_bucket(user_key) if user_key and self.user_rate > 0 else None
+                        wait = max(
+                            self.global_bucket.wait_time(now) if self.global_bucket else 0.0,
+                            user_bucket.wait_time(now) if user_bucket else 0.0
+                        )
+                        if wait <= 0:
+                            if self.global_bucket:
+                                self.global_bucket.take()
+                            if user_bucket:
+                                user_bucket.take()
+                            self._in_flight += 1
+                            self.stats['requests'] += 1
+                            return
+                self._cond.wait(timeout=wait)
+
+    def _release(self, outcome, retry_after=0.0):
+        with self._cond:
+            self._in_flight -= 1
+            if outcome == 'rate_limited':
+                self.stats['rate_limited'] += 1
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self._successes = 0
+                # A Retry-After past max_retry_after isn't waited out (the 429 goes back to the caller),
+                # so it mustn't hold every other request for that long either
+                pause = min(retry_after, self.max_retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            elif outcome == 'ok':
+                self._successes += 1
+                if self._successes >= self.concurrency_limit:
+                    self._successes = 0
+                    self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1)
+            self._cond.notify_all()
+
+    def send(self, user_key, send_request):
+        """Runs `send_request` when the budgets allow it, retrying it after 429s."""
+        for attempt in range(self.max_retries + 1):
+            self._acquire(user_key)
+            outcome = 'error'
+            retry_after = 0.0
+            try:
+                response = send_request()
+                outcome = 'ok'
+                if response.status_code == 429:
+                    outcome = 'rate_limited'
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                self._release(outcome, retry_after)
+
+            if outcome != 'rate_limited' or attempt == self.max_retries or retry_after > self.max_retry_after:
+                # Out of retries: spotipy turns the 429 into a SpotifyException
+                return response
+            with self._cond:
+                self.stats['retried'] += 1
+            print(f"Rate limited by Spotify, retrying in {retry_after:.1f}s")
+
+
+def parse_retry_after(value, default=1.0):
+    """Seconds to wait from a Retry-After header (Spotify sends whole seconds)."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def rate_limit_key(authorization):
+    """Per-user rate limit key: a short hash of the bearer token, or None for non-user requests."""
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    return hashlib.sha1(authorization.encode()).hexdigest()[:16]
+
+
+class ExchangeRecorder:
+    """
+    Appends every Spotify request/response to a JSON-lines file, which fake_spotify.py
+    can replay with --replay. Tokens in responses are redacted, request headers aren't kept.
+    """
+
+    REDACTED_FIELDS = ('access_token', 'refresh_token')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, method, url, params, response):
+        parsed = urlsplit(url)
+        query = parse_qsl(parsed.query) + [
+            (key, str(value)) for key, value in (params or {}).items() if value is not None
+        ]
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            body = {k: ('REDACTED' if k in self.REDACTED_FIELDS else v) for k, v in body.items()}
+        entry = {
+            'method': method.upper(),
+            'path': parsed.path,
+            'query': sorted(query),
+            'status': response.status_code,
+            'headers': {k: response.headers[k] for k in ('Retry-After', 'ETag') if k in response.headers},
+            'body': body,
+        }
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+def response_cache_key(url, params, user_id):
+    """
+    Cache key for a GET. Responses under /me (or in the token's market) differ per user, so
+    those are keyed by the Spotify user ID, which outlives the hourly token refresh; without a
+    known user they aren't cached (None). Everything else is shared: its ETag tells users' views apart.
+    """
+    query = sorted((key, str(value)) for key, value in (params or {}).items() if value is not None)
+    per_user = 'me' in urlsplit(url).path.split('/') or any(value == 'from_token' for _, value in query)
+    if per_user and not user_id:
+        return None
+    return f"{user_id if per_user else '*'} {url} {json.dumps(query)}"
+
+
+class SpotifySession(requests.Session):
+    """
+    requests.Session that sends every request through a RateLimitScheduler.
+    With a `response_cache`, GET responses that carry an ETag are kept, and the next GET of the
+    same URL is sent with If-None-Match. A 304 is answered from the cache as the original 200,
+    so spotipy never sees it. `cache_stats` counts conditional requests and the 304s they got.
+    Per-user responses are cached once a /me response has told us whose token it is.
+    Cookies are never stored: the session is shared by every user, so a cookie set in response
+    to one user's request would otherwise be sent with everyone else's.
+    """
+
+    def __init__(self, scheduler, recorder=None, response_cache=None):
+        super().__init__()
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.scheduler = scheduler
+        self.recorder = recorder
+        self.response_cache = response_cache
+        self.cache_stats = {'conditional': 0, 'not_modified': 0}
+        self._stats_lock = threading.Lock()
+
+    def close(self):
+        """
+        Does nothing. spotipy clients and OAuth managers close their session when they're garbage
+        collected, but this one is shared by the whole process: closing it would drop every pooled
+        connection after each request, including ones other threads are still using.
+        """
+
+    def request(self, method, url, *args, **kwargs):
+        send = super().request
+        headers = kwargs.get('headers') or {}
+        user_key = rate_limit_key(headers.get('Authorization'))
+
+        caching = self.response_cache is not None and method.upper() == 'GET'
+        cache_key = cached = None
+        if caching:
+            user_id = self.response_cache.get(f"token {user_key}") if user_key else None
+            cache_key = response_cache_key(url, kwargs.get('params'), user_id)
+            cached = self.response_cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                kwargs['headers'] = dict(headers, **{'If-None-Match': cached['etag']})
+
+        response = self.scheduler.send(user_key, lambda: send(method, url, *args, **kwargs))
+
+        if caching and cache_key is None and user_key and response.status_code == 200 and urlsplit(url).path.endswith('/me'):
+            # First /me with this token: remember whose it is, for as long as the cache keeps it
+            try:
+                user_id = response.json().get('id')
+            except ValueError:
+                user_id = None
+            if user_id:
+                self.response_cache.set(f"token {user_key}", user_id, weight=len(user_id))
+                cache_key = response_cache_key(url, kwargs.get('params'), user_id)
+
+        if cache_key is not None:
+            if cached is not None:
+                with self._stats_lock:
+                    self.cache_stats['conditional'] += 1
+                    if response.status_code == 304:
+                        self.cache_stats['not_modified'] += 1
+            if response.status_code == 304 and cached is not None:
+                response = cached_response(cached, response)
+            elif response.status_code == 200 and response.headers.get('ETag'):
+                body = response.text
+                self.response_cache.set(cache_key, {
+                    'etag': response.headers['ETag'],
+                    'content_type': response.headers.get('Content-Type'),
+                    'body': body,
+                }, weight=max(len(body), 1))
+
+        if self.recorder:
+            self.recorder.record(method, url, kwargs.get('params'), response)
+        return response
+
+
+def cached_response(cached, not_modified):
+    """The 200 a 304 (`not_modified`) stands for, rebuilt from a SpotifySession cache entry."""
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response._content = cached['body'].encode('utf-8')
+    response.encoding = 'utf-8'
+    response.headers['ETag'] = cached['etag']
+    if cached.get('content_type'):
+        response.headers['Content-Type'] = cached['content_type']
+    response.url = not_modified.url
+    response.request = not_modified.request
+    response.elapsed = not_modified.elapsed
+    return response
+
+
+def build_http_session():
+    """
+    Builds the session shared by every Spotify client and OAuth manager in this process.
+    Its connection pool keeps TCP/TLS connections alive between page fetches and between
+    requests, and urllib3's pool is safe to use from the concurrent fetch threads.
+    Server errors are retried here, 429s are left to RATE_LIMITER.
+    """
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,  # Or urllib3 would swallow 429s before the scheduler sees them
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    recorder = ExchangeRecorder(SPOTIFY_RECORD_PATH) if SPOTIFY_RECORD_PATH else None
+    response_cache = make_cache(HTTP_CACHE_PATH, HTTP_CACHE_MAX_BYTES) if HTTP_CACHE_MAX_BYTES > 0 else None
+    http_session = SpotifySession(RATE_LIMITER, recorder, response_cache)
+    http_session.mount("https://", adapter)
+    http_session.mount("http://", adapter)
+    return http_session
+
+
+RATE_LIMITER = RateLimitScheduler(
+    global_rate=RATE_LIMIT_GLOBAL_RPS,
+    global_burst=RATE_LIMIT_GLOBAL_BURST,
+    user_rate=RATE_LIMIT_USER_RPS,
+    user_burst=RATE_LIMIT_USER_BURST,
+    initial_concurrency=RATE_LIMIT_INITIAL_CONCURRENCY,
+    max_concurrency=RATE_LIMIT_MAX_CONCURRENCY,
+    max_retry_after=RATE_LIMIT_MAX_RETRY_AFTER,
+    max_retries=RATE_LIMIT_MAX_RETRIES,
+)
+HTTP_SESSION = build_http_session()
+
+
+# --- PAGED FETCH HELPERS ---
+
+def _fetch_remaining_pages(fetch_page, limit, first_page):
+    """Walks the pages after `first_page` one by one, for responses that carry no total."""
+    items = []
+    offset = limit
+    page = first_page
+    while page.get('items'):
+        page = fetch_page(limit=limit, offset=offset)
+        items.extend(page.get('items') or [])
+        offset += limit
+    return items
+
+
+async def fetch_pages_async(sources, max_in_flight=FETCH_MAX_WORKERS):
+    """
+    Async fetch engine: every page request of every source is a task on one event loop.
+    `sources` is a list of (fetch_page, limit) pairs, or (fetch_page, limit, first_page) when the
+    caller already has the first page. The first page of each source tells us its total, then all
+    its remaining pages are requested at once.
+    The spotipy calls themselves block, so they run on the engine's shared thread pool, at most
+    `max_in_flight` at a time, and still go through HTTP_SESSION (connection pool and RATE_LIMITER).
+    Yields (source_index, items) as each source finishes, with items in page order.
+    """
+    loop = asyncio.get_running_loop()
+    _, executor = fetch_engine()
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def call(func, /, **kwargs):
+        async with in_flight:
+            return await loop.run_in_executor(executor, partial(func, **kwargs))
+
+    async def fetch_source(index):
+        fetch_page, limit, *fetched = sources[index]
+        first_page = fetched[0] if fetched else await call(fetch_page, limit=limit, offset=0)
+        items = list(first_page.get('items') or [])
+        total = first_page.get('total')
+        if total is None:
+            # No total in the response (e.g. filtered out by `fields`)
+            items.extend(await call(_fetch_remaining_pages, fetch_page=fetch_page, limit=limit, first_page=first_page))
+        else:
+            pages = await asyncio.gather(*(
+                call(fetch_page, limit=limit, offset=offset)
+                for offset in range(limit, total, limit)
+            ))
+            for page in pages:
+                items.extend(page.get('items') or [])
+        return index, items
+
+    tasks = [asyncio.ensure_future(fetch_source(index)) for index in range(len(sources))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+_fetch_engine = None  # (event loop, thread pool), started on first use
+_fetch_engine_lock = threading.Lock()
+
+
+def fetch_engine():
+    """
+    The event loop the async fetch engine runs on, on its own daemon thread, and the thread pool
+    its blocking spotipy calls run on. Both are started on first use and shared by every request.
+    The pool only needs as many threads as RATE_LIMITER ever lets requests out at once.
+    """
+    global _fetch_engine
+    with _fetch_engine_lock:
+        if _fetch_engine is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="fetch-engine", daemon=True).start()
+            executor = ThreadPoolExecutor(max_workers=RATE_LIMIT_MAX_CONCURRENCY, thread_name_prefix="fetch")
+            _fetch_engine = (loop, executor)
+        return _fetch_engine
+
+
+def _reset_fetch_engine():
+    # A forked child has none of the engine's threads, so it starts its own on first use
+    global _fetch_engine, _fetch_engine_lock
+    _fetch_engine = None
+    _fetch_engine_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_fetch_engine)
+
+
+def iterate_async(async_iterable):
+    """
+    Sync bridge for the async fetch engine: runs `async_iterable` on the engine's event loop,
+    which keeps it going while the caller works on what it already got, and yields its values
+    as they arrive, so Flask routes can use it like a normal generator.
+    Closing the generator early cancels what's left.
+    """
+    loop, _ = fetch_engine()
+    values = queue.Queue()
+    done = object()
+
+    async def run():
+        try:
+            async with aclosing(async_iterable) as iterator:
+                async for value in iterator:
+                    values.put(value)
+        finally:
+            values.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(run(), loop)
+    try:
+        while True:
+            value = values.get()
+            if value is done:
+                break
+            yield value
+        future.result()  # Raises whatever stopped the engine early
+    finally:
+        future.cancel()
+
+
+def fetch_pages_concurrently(sources, max_workers=FETCH_MAX_WORKERS):
+    """
+    Fetches every item of several paged Spotify endpoints at once, on the async engine.
+    `max_workers` caps the requests in flight across all sources.
+    Yields (source_index, items) as each source finishes, with items in page order.
+    """
+    return iterate_async(fetch_pages_async(sources, max_workers))
+
+
+def fetch_all_pages(fetch_page, limit, max_workers=FETCH_MAX_WORKERS, first_page=None):
+    """
+    Fetches every item of a paged Spotify endpoint.
+    The first page (fetched here unless passed in) tells us the total, so the remaining offsets
+    are fetched in parallel on a bounded thread pool and the pages are put back in order.
+    """
+    source = (fetch_page, limit) if first_page is None else (fetch_page, limit, first_page)
+    for _, items in fetch_pages_concurrently([source], max_workers):
+        return items
+
+
+def fetch_tracks_in_batches(sp, track_ids, market=None):
+    """
+    Fetches the full tracks of `track_ids`, 50 IDs per tracks request, in parallel on a bounded
+    thread pool. Yields (track_id, full_track) for every ID Spotify knows. A batch whose request
+    fails is reported and skipped.
+    """
+    batches = [track_ids[i:i + 50] for i in range(0, len(track_ids), 50)]
+
+    def fetch_batch(batch):
+        try:
+            return batch, sp.tracks(batch, market=market).get('tracks') or []
+        except Exception as e:
+            print(f"Tracks request failed for {len(batch)} tracks: {e}")
+            return batch, []
+
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as pool:
+        for batch, full_tracks in pool.map(fetch_batch, batches):
+            # The tracks endpoint answers in request order, with null for unknown IDs
+            for track_id, full_track in zip(batch, full_tracks):
+                if full_track is not None:
+                    yield track_id, full_track
+
+
+def tracks_from_items(items):
+    """Pulls the track out of each playlist/library item, skipping empty entries and tracks without an ID."""
+    tracks = []
+    for item in items:
+        track = item.get('track') if item else None
+        if track and track.get('id'):
+            tracks.append(track)
+    return tracks
+
+
+def compact_track(track):
+    """Keeps only the track fields the matcher uses, for storing tracks compactly."""
+    isrc = (track.get('external_ids') or {}).get('isrc')
+    return {
+        'id': track.get('id'),
+        'name': track.get('name'),
+        'duration_ms': track.get('duration_ms'),
+        'artists': [{'id': a.get('id'), 'name': a.get('name')} for a in track.get('artists') or []],
+        'external_ids': {'isrc': isrc} if isrc else {},
+    }
+
+
+def fetch_playlist_tracks(sp, playlist_id, fields, market=None):
+    """
+    Fetches all tracks of a playlist.
+    `fields` must include `total` so the pages can be fetched in parallel.
+    """
+    fetch_page = partial(sp.playlist_items, playlist_id, fields=fields, market=market)
+    return tracks_from_items(fetch_all_pages(fetch_page, limit=100))
+
+
+def fetch_target_tracks(sp, playlist_id, market, snapshot_id=None):
+    """
+    Fetches the target playlist in one sweep with `market` set, so every track
+    carries `is_playable` along with the fields the matcher needs.
+    Relinked tracks get their original ID back, since that's the one stored in the playlist.
+
+    Given the playlist's snapshot_id, an unchanged playlist comes from PLAYLIST_CACHE instead
+    and only tracks whose availability is stale are re-checked (see refresh_availability).
+    """
+    key = playlist_cache_key(playlist_id, snapshot_id, f"{TARGET_TRACK_FIELDS}:{market}") if snapshot_id else None
+    cached_tracks = PLAYLIST_CACHE.get(key) if key else None
+    if cached_tracks is not None:
+        tracks = [dict(track) for track in cached_tracks]
+        stale_ids = stale_availability_ids(tracks, market)
+        # Re-paging checks 100 tracks per request and the tracks endpoint 50, so when most
+        # of the playlist is stale it's cheaper to fetch it again.
+        if len(stale_ids) <= len(tracks) / 2:
+            refresh_availability(sp, tracks, stale_ids, market)
+            return tracks
+
+    tracks = fetch_playlist_tracks(sp, playlist_id, fields=TARGET_TRACK_FIELDS, market=market)
+    for track in tracks:
+        linked_from = track.pop('linked_from', None)
+        if linked_from and linked_from.get('id'):
+            track['id'] = linked_from['id']
+    remember_availability(tracks, market)
+    if key:
+        PLAYLIST_CACHE.set(key, tracks, weight=max(len(tracks), 1))
+    return tracks
+
+
+def remember_availability(tracks, market):
+    """Stores the `is_playable` of tracks fetched with `market` set in AVAILABILITY_CACHE."""
+    checked_at = time.time()
+    for track in tracks:
+        if track.get('id') and 'is_playable' in track:
+            AVAILABILITY_CACHE.set(f"{market}:{track['id']}", (track['is_playable'], checked_at))
+
+
+def stale_availability_ids(tracks, market):
+    """IDs of the tracks whose availability in `market` is unknown or older than AVAILABILITY_TTL."""
+    now = time.time()
+    stale_ids = []
+    seen = set()
+    for track in tracks:
+        track_id = track.get('id')
+        if not track_id or track_id in seen:
+            continue
+        seen.add(track_id)
+        cached = AVAILABILITY_CACHE.get(f"{market}:{track_id}")
+        if cached is None or now - cached[1] > AVAILABILITY_TTL:
+            stale_ids.append(track_id)
+    return stale_ids
+
+
+def refresh_availability(sp, tracks, stale_ids, market):
+    """
+    Checks the availability of `stale_ids` in `market`, 50 IDs per tracks request, then sets
+    `is_playable` on every track from AVAILABILITY_CACHE. A track that can't be checked keeps
+    the answer it had.
+    """
+    checked_at = time.time()
+    for track_id, full_track in fetch_tracks_in_batches(sp, stale_ids, market=market):
+        AVAILABILITY_CACHE.set(f"{market}:{track_id}", (full_track.get('is_playable', True), checked_at))
+
+    for track in tracks:
+        cached = AVAILABILITY_CACHE.get(f"{market}:{track['id']}") if track.get('id') else None
+        if cached is not None:
+            track['is_playable'] = cached[0]
+
+
+def playlist_cache_key(playlist_id, snapshot_id, fields):
+    """Cache key for a playlist's contents at a given snapshot and field projection."""
+    return f"playlist:{playlist_id}:{snapshot_id}:{fields}"
+
+
+def _liked_song_entry(item):
+    """Mirror entry for a saved-track item: its added_at and the compacted track."""
+    track = item.get('track')
+    return {
+        'added_at': item.get('added_at') or '',
+        'track': compact_track(track) if track else None,
+    }
+
+
+def sync_liked_songs(sp, user_id):
+    """
+    Returns the user's Liked Songs (newest first) from a mirror kept in PLAYLIST_CACHE
+    (or LIBRARY_MIRROR when configured).
+    Saved tracks come back newest first, so we only walk pages until we reach the
+    mirror's newest `added_at` (the watermark). If the mirror's size then doesn't match
+    the library total, songs were removed since the last sync and we resync everything.
+    """
+    key = f"liked:{user_id}"
+    limit = 50
+    mirror = LIBRARY_MIRROR.liked_entries(user_id) if LIBRARY_MIRROR is not None else PLAYLIST_CACHE.get(key)
+    first_page = page = sp.current_user_saved_tracks(limit=limit, offset=0)
+    total = page.get('total') or 0
+
+    entries = None
+    if mirror:
+        watermark = mirror[0]['added_at']
+        known_at_watermark = {e['track']['id'] for e in mirror if e['added_at'] == watermark and e['track']}
+        new_entries = []
+        offset = 0
+        reached_watermark = False
+        while not reached_watermark:
+            for item in page.get('items') or []:
+                entry = _liked_song_entry(item)
+                track_id = entry['track']['id'] if entry['track'] else None
+                if entry['added_at'] < watermark or (entry['added_at'] == watermark and track_id in known_at_watermark):
+                    reached_watermark = True
+                    break
+                new_entries.append(entry)
+            offset += limit
+            if reached_watermark or not page.get('items') or offset >= total:
+                break
+            page = sp.current_user_saved_tracks(limit=limit, offset=offset)
+
+        # A re-saved song moves to the top, so drop its old position
+        new_ids = {e['track']['id'] for e in new_entries if e['track']}
+        entries = new_entries + [e for e in mirror if not (e['track'] and e['track']['id'] in new_ids)]
+        if len(entries) != total:
+            print(f"Liked Songs mirror out of sync ({len(entries)} vs {total}), resyncing.")
+            entries = None
+
+    if entries is None:
+        items = fetch_all_pages(sp.current_user_saved_tracks, limit, first_page=first_page)
+        entries = [_liked_song_entry(item) for item in items]
+
+    if entries != mirror:
+        if LIBRARY_MIRROR is not None:
+            LIBRARY_MIRROR.save_liked_entries(user_id, entries)
+        else:
+            PLAYLIST_CACHE.set(key, entries, weight=max(len(entries), 1))
+    return [e['track'] for e in entries if e['track'] and e['track'].get('id')]
+
+
+def fetch_filter_sources(sp, user_id, include_liked_songs, filter_playlist_ids):
+    """
+    Fetches the tracks of every selected filter source (Liked Songs and playlists) concurrently.
+    Playlists whose snapshot_id is already in PLAYLIST_CACHE cost a single metadata call,
+    and Liked Songs is synced incrementally (see sync_liked_songs). With LIBRARY_MIRROR the
+    snapshot_ids come from the mirror's playlist list and unchanged playlists cost no calls.
+    Yields (source_index, tracks, version) as each source finishes. Liked Songs, when included,
+    is source 0 and the playlists follow in the order they were selected. `version` changes
+    whenever the source's tracks do: a playlist's ID and snapshot_id (None if the snapshot_id
+    is unknown) or, for Liked Songs, a hash of its track IDs.
+    """
+    playlist_ids = [pid for pid in filter_playlist_ids if pid != "liked_songs"]
+    first_playlist_index = 1 if include_liked_songs else 0
+
+    with ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as pool:
+        liked_future = pool.submit(sync_liked_songs, sp, user_id) if include_liked_songs else None
+
+        # Look up every playlist's current snapshot_id
+        if LIBRARY_MIRROR is not None:
+            snapshot_ids = LIBRARY_MIRROR.snapshot_ids(sp, user_id, playlist_ids)
+        else:
+            snapshot_ids = list(pool.map(
+                lambda pid: sp.playlist(pid, fields="snapshot_id").get('snapshot_id'),
+                playlist_ids
+            ))
+        versions = [f"{pid}:{snapshot_id}" if snapshot_id else None for pid, snapshot_id in zip(playlist_ids, snapshot_ids)]
+
+        sources = []
+        source_indexes = []
+        cache_keys = {}
+        for position, (playlist_id, snapshot_id) in enumerate(zip(playlist_ids, snapshot_ids)):
+            source_index = first_playlist_index + position
+            if LIBRARY_MIRROR is not None:
+                cached_tracks = LIBRARY_MIRROR.playlist_tracks(playlist_id, snapshot_id)
+                if cached_tracks is not None:
+                    yield source_index, cached_tracks, versions[position]
+                    continue
+            elif snapshot_id:
+                key = playlist_cache_key(playlist_id, snapshot_id, FILTER_TRACK_FIELDS)
+                cached_tracks = PLAYLIST_CACHE.get(key)
+                if cached_tracks is not None:
+                    yield source_index, cached_tracks, versions[position]
+                    continue
+                cache_keys[source_index] = key
+            sources.append((partial(sp.playlist_items, playlist_id, fields=FILTER_TRACK_FIELDS), 100))
+            source_indexes.append(source_index)
+
+        for index, items in fetch_pages_concurrently(sources):
+            source_index = source_indexes[index]
+            position = source_index - first_playlist_index
+            tracks = tracks_from_items(items)
+            if LIBRARY_MIRROR is not None:
+                # Use the compacted tracks the mirror stored, so later joins there see exactly these
+                tracks = LIBRARY_MIRROR.save_playlist_items(playlist_ids[position], snapshot_ids[position], items)
+            elif source_index in cache_keys:
+                PLAYLIST_CACHE.set(cache_keys[source_index], tracks, weight=max(len(tracks), 1))
+            yield source_index, tracks, versions[position]
+
+        if liked_future is not None:
+            liked_tracks = liked_future.result()
+            liked_ids = '\n'.join(track['id'] for track in liked_tracks)
+            yield 0, liked_tracks, hashlib.sha1(liked_ids.encode()).hexdigest()
+
+
+def backfill_isrcs(sp, tracks):
+    """
+    Looks up the ISRC of every track that has none, 50 IDs per tracks request,
+    and fills in its `external_ids` in place. Returns the tracks that got one.
+    """
+    missing = {}
+    for track in tracks:
+        if track.get('id') and not (track.get('external_ids') or {}).get('isrc'):
+            missing.setdefault(track['id'], []).append(track)
+    found = []
+    for track_id, full_track in fetch_tracks_in_batches(sp, list(missing)):
+        isrc = (full_track.get('external_ids') or {}).get('isrc')
+        if isrc:
+            for track in missing[track_id]:
+                track['external_ids'] = {'isrc': isrc}
+                found.append(track)
+    return found
+
+
+class FilterCorpus:
+    """
+    The filter tracks of a run, deduplicated by track ID as each source comes in and reduced to
+    the fields the matcher uses (see compact_track). `sources` maps each track ID to the indexes
+    of the sources (as yielded by fetch_filter_sources) that contain it.
+    """
+
+    def __init__(self):
+        self.sources = {}  # track ID -> source indexes, in the order they were added
+        self._tracks = {}  # track ID -> compact track
+        self._first_seen = {}  # track ID -> (source index, position) of its earliest occurrence
+        self._versions = {}  # source index -> version, as yielded by fetch_filter_sources
+
+    def add_source(self, source_index, tracks, version=None):
+        self._versions[source_index] = version
+        for position, track in enumerate(tracks):
+            track_id = track['id']
+            sources = self.sources.get(track_id)
+            if sources is None:
+                self.sources[track_id] = [source_index]
+                self._tracks[track_id] = compact_track(track)
+                self._first_seen[track_id] = (source_index, position)
+                continue
+            if sources[-1] != source_index:
+                sources.append(source_index)
+            if (source_index, position) < self._first_seen[track_id]:
+                self._first_seen[track_id] = (source_index, position)
+
+    def tracks(self):
+        """Every distinct track, ordered by its first occurrence across the sources in index order."""
+        return [self._tracks[track_id] for track_id in sorted(self._first_seen, key=self._first_seen.get)]
+
+    def version(self):
+        """Identifies the corpus from its sources' versions, or None if any of them is unknown."""
+        versions = sorted(self._versions.items())
+        if not versions or any(version is None for _, version in versions):
+            return None
+        return hashlib.sha1(json.dumps(versions).encode()).hexdigest()
+
+    def __contains__(self, track_id):
+        return track_id in self._tracks
+
+    def __len__(self):
+        return len(self._tracks)
+
+
+# --- LIBRARY MIRROR ---
+
+class LibraryMirror:
+    """
+    Local copy of users' libraries in a SQLite file: each user's playlist list (with every
+    playlist's snapshot_id), the items of each playlist at the snapshot they were downloaded at,
+    each user's Liked Songs, and the compacted tracks they point at. Items and liked songs are
+    indexed by track ID and tracks by ISRC and normalized title, so exact-ID and ISRC matches
+    against the filter sources are joins here.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS user_playlists ("
+                " user_id TEXT NOT NULL, position INTEGER NOT NULL, playlist_id TEXT NOT NULL,"
+                " name TEXT, images TEXT, snapshot_id TEXT, total INTEGER,"
+                " PRIMARY KEY (user_id, position));"
+                "CREATE TABLE IF NOT EXISTS playlists_synced ("
+                " user_id TEXT PRIMARY KEY, synced_at REAL NOT NULL);"
+                "CREATE TABLE IF NOT EXISTS playlist_snapshots ("
+                " playlist_id TEXT PRIMARY KEY, snapshot_id TEXT);"
+                "CREATE TABLE IF NOT EXISTS playlist_items ("
+                " playlist_id TEXT NOT NULL, position INTEGER NOT NULL, track_id TEXT NOT NULL,"
+                " PRIMARY KEY (playlist_id, position));"
+                "CREATE INDEX IF NOT EXISTS playlist_items_track ON playlist_items (track_id);"
+                "CREATE TABLE IF NOT EXISTS liked_songs ("
+                " user_id TEXT NOT NULL, position INTEGER NOT NULL, added_at TEXT NOT NULL, track_id TEXT,"
+                " PRIMARY KEY (user_id, position));"
+                "CREATE INDEX IF NOT EXISTS liked_songs_track ON liked_songs (track_id);"
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                " track_id TEXT PRIMARY KEY, data TEXT NOT NULL, isrc TEXT, norm_title TEXT);"
+                "CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);"
+                "CREATE INDEX IF NOT EXISTS tracks_norm_title ON tracks (norm_title);"
+                "CREATE TABLE IF NOT EXISTS isrc_lookups (track_id TEXT PRIMARY KEY);"
+            )
+
+    def _connect(self):
+        return connect_sqlite(self.path)
+
+    @staticmethod
+    def _write_tracks(conn, tracks):
+        """Stores (or refreshes) the compacted tracks on an open connection, as part of its transaction."""
+        rows = []
+        for track in tracks:
+            track = compact_track(track)
+            isrc = track['external_ids'].get('isrc')
+            rows.append((track['id'], json.dumps(track), isrc, normalize_title(track.get('name') or '')))
+        conn.executemany("INSERT OR REPLACE INTO tracks (track_id, data, isrc, norm_title) VALUES (?, ?, ?, ?)", rows)
+
+    def save_tracks(self, tracks):
+        """Stores (or refreshes) the compacted tracks."""
+        if not tracks:
+            return
+        with self._connect() as conn:
+            self._write_tracks(conn, tracks)
+
+    def backfill_isrcs(self, sp, tracks):
+        """
+        backfill_isrcs that remembers what it found: ISRCs the mirror already knows are filled in
+        from it, and tracks that were looked up before without getting one aren't asked for again.
+        Returns the tracks that got an ISRC.
+        """
+        missing = [t for t in tracks if t.get('id') and not (t.get('external_ids') or {}).get('isrc')]
+        if not missing:
+            return []
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE wanted (track_id TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO temp.wanted (track_id) VALUES (?)", [(t['id'],) for t in missing])
+            known = dict(conn.execute(
+                "SELECT w.track_id, t.isrc FROM temp.wanted w JOIN tracks t ON t.track_id = w.track_id WHERE t.isrc IS NOT NULL"
+            ).fetchall())
+            looked_up = {track_id for (track_id,) in conn.execute(
+                "SELECT w.track_id FROM temp.wanted w JOIN isrc_lookups l ON l.track_id = w.track_id"
+            )}
+
+        filled = []
+        to_look_up = []
+        for track in missing:
+            if track['id'] in known:
+                track['external_ids'] = {'isrc': known[track['id']]}
+                filled.append(track)
+            elif track['id'] not in looked_up:
+                to_look_up.append(track)
+
+        found = backfill_isrcs(sp, to_look_up)
+        self.save_tracks(found)
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO isrc_lookups (track_id) VALUES (?)", [(t['id'],) for t in to_look_up])
+        return filled + found
+
+    # Playlists
+
+    def sync_playlists(self, sp, user_id, max_age=None):
+        """
+        Lists the user's playlists from the API, unless that was done less than `max_age`
+        (default LIBRARY_MIRROR_TTL) seconds ago. Returns True if they were listed.
+        """
+        max_age = LIBRARY_MIRROR_TTL if max_age is None else max_age
+        with self._connect() as conn:
+            row = conn.execute("SELECT synced_at FROM playlists_synced WHERE user_id = ?", (user_id,)).fetchone()
+        if row is not None and time.time() - row[0] < max_age:
+            return False
+
+        rows = []
+        for item in fetch_all_pages(sp.current_user_playlists, limit=50):
+            try:
+                rows.append((
+                    user_id, len(rows), item['id'], item['name'], json.dumps(item.get('images') or []),
+                    item.get('snapshot_id'), item['tracks']['total']
+                ))
+            except Exception:
+                pass
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM user_playlists WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO user_playlists (user_id, position, playlist_id, name, images, snapshot_id, total)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            conn.execute("INSERT OR REPLACE INTO playlists_synced (user_id, synced_at) VALUES (?, ?)", (user_id, time.time()))
+        return True
+
+    def expire_playlists(self, user_id):
+        """Makes the next sync_playlists list the user's playlists again, e.g. after editing one."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM playlists_synced WHERE user_id = ?", (user_id,))
+
+    def playlists(self, user_id):
+        """The user's playlists as last listed, shaped like the index page expects."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT playlist_id, name, images, total FROM user_playlists WHERE user_id = ? ORDER BY position",
+                (user_id,)
+            ).fetchall()
+        return [
+            {'id': playlist_id, 'name': name, 'images': json.loads(images), 'tracks': {'total': total}}
+            for playlist_id, name, images, total in rows
+        ]
+
+    def snapshot_ids(self, sp, user_id, playlist_ids):
+        """
+        Current snapshot_id of each playlist, from the user's playlist list, listed again right now:
+        a run removes tracks based on these, so a playlist edited in Spotify since the last listing
+        must not be matched at its old contents. Playlists that aren't in the list are looked up one by one.
+        """
+        self.sync_playlists(sp, user_id, max_age=0)
+        with self._connect() as conn:
+            listed = dict(conn.execute(
+                "SELECT playlist_id, snapshot_id FROM user_playlists WHERE user_id = ?", (user_id,)
+            ).fetchall())
+        return [
+            listed[pid] if listed.get(pid) else sp.playlist(pid, fields="snapshot_id").get('snapshot_id')
+            for pid in playlist_ids
+        ]
+
+    def playlist_tracks(self, playlist_id, snapshot_id):
+        """The playlist's tracks in order if the mirror has it at `snapshot_id`, otherwise None."""
+        if not snapshot_id:
+            return None
+        with self._connect() as conn:
+            row = conn.execute("SELECT snapshot_id FROM playlist_snapshots WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            if row is None or row[0] != snapshot_id:
+                return None
+            rows = conn.execute(
+                "SELECT t.data FROM playlist_items i JOIN tracks t ON t.track_id = i.track_id"
+                " WHERE i.playlist_id = ? ORDER BY i.position", (playlist_id,)
+            ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def save_playlist_items(self, playlist_id, snapshot_id, items):
+        """Replaces the playlist's stored items. Returns its compacted tracks in order."""
+        tracks = []
+        item_rows = []
+        for position, item in enumerate(items):
+            track = item.get('track') if item else None
+            if track and track.get('id'):
+                tracks.append(compact_track(track))
+                item_rows.append((playlist_id, position, track['id']))
+
+        with self._connect() as conn:
+            self._write_tracks(conn, tracks)
+            conn.execute("DELETE FROM playlist_items WHERE playlist_id = ?", (playlist_id,))
+            conn.executemany("INSERT INTO playlist_items (playlist_id, position, track_id) VALUES (?, ?, ?)", item_rows)
+            conn.execute(
+                "INSERT OR REPLACE INTO playlist_snapshots (playlist_id, snapshot_id) VALUES (?, ?)",
+                (playlist_id, snapshot_id)
+            )
+        return tracks
+
+    # Liked Songs
+
+    def liked_entries(self, user_id):
+        """The user's Liked Songs mirror entries (see sync_liked_songs), newest first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT l.added_at, t.data FROM liked_songs l LEFT JOIN tracks t ON t.track_id = l.track_id"
+                " WHERE l.user_id = ? ORDER BY l.position", (user_id,)
+            ).fetchall()
+        return [{'added_at': added_at, 'track': json.loads(data) if data else None} for added_at, data in rows]
+
+    def save_liked_entries(self, user_id, entries):
+        """Replaces the user's Liked Songs mirror entries."""
+        tracks = [entry['track'] for entry in entries if entry['track'] and entry['track'].get('id')]
+        with self._connect() as conn:
+            self._write_tracks(conn, tracks)
+            conn.execute("DELETE FROM liked_songs WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO liked_songs (user_id, position, added_at, track_id) VALUES (?, ?, ?, ?)",
+                [
+                    (user_id, position, entry['added_at'], entry['track'].get('id') if entry['track'] else None)
+                    for position, entry in enumerate(entries)
+                ]
+            )
+
+    # Joins against the filter sources
+
+    def _filter_occurrences(self, conn, user_id, include_liked_songs, filter_playlist_ids):
+        """
+        Loads the filter sources into a temp table and returns a CTE naming every occurrence of a
+        track in them as `occurrences (source_index, position, track_id)`, numbered like
+        fetch_filter_sources does, plus its parameters.
+        """
+        playlist_ids = [pid for pid in filter_playlist_ids if pid != "liked_songs"]
+        first_playlist_index = 1 if include_liked_songs else 0
+        conn.execute("CREATE TEMP TABLE sources (playlist_id TEXT, source_index INTEGER)")
+        conn.executemany(
+            "INSERT INTO temp.sources (playlist_id, source_index) VALUES (?, ?)",
+            [(pid, first_playlist_index + position) for position, pid in enumerate(playlist_ids)]
+        )
+        cte = (
+            "WITH occurrences AS ("
+            " SELECT s.source_index, i.position, i.track_id"
+            " FROM temp.sources s JOIN playlist_items i ON i.playlist_id = s.playlist_id"
+            " UNION ALL"
+            " SELECT 0, l.position, l.track_id FROM liked_songs l"
+            " WHERE ? AND l.user_id = ? AND l.track_id IS NOT NULL) "
+        )
+        return cte, (1 if include_liked_songs else 0, user_id)
+
+    def exact_matches(self, user_id, include_liked_songs, filter_playlist_ids, track_ids):
+        """The IDs among `track_ids` that are in any of the filter sources."""
+        with self._connect() as conn:
+            cte, params = self._filter_occurrences(conn, user_id, include_liked_songs, filter_playlist_ids)
+            conn.execute("CREATE TEMP TABLE targets (track_id TEXT)")
+            conn.executemany("INSERT INTO temp.targets (track_id) VALUES (?)", [(tid,) for tid in track_ids])
+            rows = conn.execute(
+                cte + "SELECT DISTINCT t.track_id FROM temp.targets t JOIN occurrences o ON o.track_id = t.track_id",
+                params
+            ).fetchall()
+        return {track_id for (track_id,) in rows}
+
+    def isrc_matches(self, user_id, include_liked_songs, filter_playlist_ids, target_tracks):
+        """
+        For every target track sharing an ISRC with a filter track, the filter track: the first one
+        in the sources, preferring one with a different ID (like FilterIndex.isrc_match).
+        Returns {target track ID: filter track}.
+        """
+        with self._connect() as conn:
+            cte, params = self._filter_occurrences(conn, user_id, include_liked_songs, filter_playlist_ids)
+            conn.execute("CREATE TEMP TABLE targets (track_id TEXT, isrc TEXT)")
+            conn.executemany(
+                "INSERT INTO temp.targets (track_id, isrc) VALUES (?, ?)",
+                [
+                    (track['id'], (track.get('external_ids') or {}).get('isrc'))
+                    for track in target_tracks if (track.get('external_ids') or {}).get('isrc')
+                ]
+            )
+            rows = conn.execute(
+                cte +
+                "SELECT target_id, data FROM ("
+                " SELECT t.track_id AS target_id, tr.data AS data, ROW_NUMBER() OVER ("
+                "  PARTITION BY t.track_id ORDER BY o.track_id = t.track_id, o.source_index, o.position) AS rank"
+                " FROM temp.targets t"
+                " JOIN tracks tr ON tr.isrc = t.isrc"
+                " JOIN occurrences o ON o.track_id = tr.track_id)"
+                " WHERE rank = 1",
+                params
+            ).fetchall()
+        return {target_id: json.loads(data) for target_id, data in rows}
+
+
+# Users' libraries, when LIBRARY_MIRROR_PATH is set (see LibraryMirror)
+LIBRARY_MIRROR = LibraryMirror(LIBRARY_MIRROR_PATH) if LIBRARY_MIRROR_PATH else None
+
+
 # --- DUPLICATE DETECTION HELPERS ---
 
+# Version indicators stripped from titles, each with the text it needs in order to match,
+# so a rule is skipped with a substring check instead of a regex pass.
+# Applied in order - ORDER MATTERS (specific before generic).
+TITLE_VERSION_RULES = [
+    # Specific remaster/re-recorded patterns first
+    (r'\s*[-–—]\s*re-?recorded.*$', ('recorded',)),  # " - Re-Recorded" at end
+    (r'\s*\(remastered\s+album\s+version\)', ('(remastered', 'album', 'version)')),
+    (r'\s*\(remastered\s+\d+\)', ('(remastered',)),
+    (r'\s*\(remaster(ed)?\s*\d*\)', ('(remaster',)),
+    (r'\s*[-–—]\s*remaster(ed)?(\s+\d+)?(\s+album\s+version)?', ('remaster',)),
+    (r'\s*[-–—]\s*\d+\s*remaster(ed)?', ('remaster',)),
+    (r'\s*\(remaster(ed)?(\s+\d+)?(\s+album\s+version)?\)', ('(remaster',)),
+    (r'\s*\(\d+\s*remaster(ed)?\)', ('(', 'remaster')),
+    # Album/version indicators
+    (r'\s*\(deluxe.*?\)', ('(deluxe',)),
+    (r'\s*\(expanded.*?\)', ('(expanded',)),
+    (r'\s*\(anniversary.*?\)', ('(anniversary',)),
+    (r'\s*\(bonus track.*?\)', ('(bonus track',)),
+    (r'\s*\(album version.*?\)', ('(album version',)),
+    (r'\s*\(original.*?\)', ('(original',)),
+    (r'\s*\(single version.*?\)', ('(single version',)),
+    (r'\s*\(radio edit.*?\)', ('(radio edit',)),
+    (r'\s*\(explicit.*?\)', ('(explicit',)),
+    (r'\s*\(clean.*?\)', ('(clean',)),
+    (r'\s*\(edit\)', ('(edit)',)),
+    (r'\s*\(re-?recorded.*?\)', ('(re', 'recorded')),
+    (r'\s*\(remix.*?\)', ('(remix',)),
+    (r'\s*[-–—]\s*remix.*$', ('remix',)),
+    (r'\s*[-–—]\s*live.*$', ('live',)),
+    (r'\s*\(live.*?\)', ('(live',)),
+    (r'\s*\(acoustic.*?\)', ('(acoustic',)),
+    (r'\s*[-–—]\s*acoustic.*$', ('acoustic',)),
+    (r'\s*[-–—]\s*from\s+".*"', ('from', '"')),
+    (r'\s*\(from\s+".*"\)', ('(from', '"')),
+    (r'\s*\(from\s+.*?\)', ('(from',)),
+    (r'\s*[-–—]\s*mono.*$', ('mono',)),
+    (r'\s*\(mono.*?\)', ('(mono',)),
+    (r'\s*[-–—]\s*stereo.*$', ('stereo',)),
+    (r'\s*\(stereo.*?\)', ('(stereo',)),
+    (r'\s*\(super\s+deluxe.*?\)', ('(super', 'deluxe')),
+    (r'\s*\(special\s+edition.*?\)', ('(special', 'edition')),
+    (r'\s*\(version\)$', ('(version)',)),
+    # Generic catch-alls LAST
+    (r'\s*\([^)]*remaster[^)]*\)', ('(', 'remaster')),  # Anything with remaster in parens
+    (r'\s*\([^)]*version\)', ('version)',)),  # Anything ending with version in parens
+    (r'\s*\([^)]*edition\)', ('edition)',)),  # Anything ending with edition in parens
+    (r'\s*\([^)]*mix\)', ('mix)',)),  # Anything ending with mix in parens
+]
+TITLE_VERSION_RULES = [(re.compile(pattern, re.IGNORECASE), needs) for pattern, needs in TITLE_VERSION_RULES]
+
+# Featuring artists, stripped after the version indicators
+TITLE_FEAT_PATTERNS = [
+    re.compile(r'\s*(feat\.?|ft\.?|featuring)\s+.*$', re.IGNORECASE),
+    re.compile(r'\s*\((feat\.?|ft\.?|featuring).*?\)', re.IGNORECASE),
+]
+
+
+# Normalized titles by raw title, shared by every request in this process (see normalize_title)
+TITLE_CACHE = MemoryCache(TITLE_CACHE_MAX_ENTRIES)
+# Identifies the rules above, so a saved title cache is only loaded by the code that wrote it
+TITLE_RULES_VERSION = hashlib.sha1(
+    repr([pattern.pattern for pattern, _ in TITLE_VERSION_RULES] + [pattern.pattern for pattern in TITLE_FEAT_PATTERNS]).encode()
+).hexdigest()[:16]
+_title_cache_saved_misses = 0
+_title_cache_saved_at = None  # time.monotonic() of the last save, None before the first
+_title_cache_save_lock = threading.Lock()
+
+
+def load_title_cache(path):
+    """Fills TITLE_CACHE from a file written by save_title_cache, if it exists and matches the rules."""
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"Couldn't load the title cache from {path}: {e}")
+        return
+    if saved.get('rules') != TITLE_RULES_VERSION:
+        print(f"Ignoring the title cache in {path}, it was made with different title rules.")
+        return
+    for title, normalized in saved.get('titles') or []:
+        TITLE_CACHE.set(title, normalized)
+
+
+def save_title_cache(path, force=False):
+    """
+    Writes TITLE_CACHE to `path` if titles were added since it was last saved, and the last save
+    was at least TITLE_CACHE_SAVE_INTERVAL seconds ago (unless `force`). Returns right away
+    if another thread is already saving.
+    """
+    global _title_cache_saved_misses, _title_cache_saved_at
+    if not _title_cache_save_lock.acquire(blocking=False):
+        return
+    try:
+        misses = TITLE_CACHE.misses
+        if misses == _title_cache_saved_misses:
+            return
+        now = time.monotonic()
+        if not force and _title_cache_saved_at is not None and now - _title_cache_saved_at < TITLE_CACHE_SAVE_INTERVAL:
+            return
+        # Counts as a save even if it fails, so a broken path isn't retried on every run
+        _title_cache_saved_at = now
+        with atomic_file(path) as f:
+            json.dump({'rules': TITLE_RULES_VERSION, 'titles': TITLE_CACHE.items()}, f)
+        _title_cache_saved_misses = misses
+    except OSError as e:
+        print(f"Couldn't save the title cache to {path}: {e}")
+    finally:
+        _title_cache_save_lock.release()
+
+
 def normalize_title(title):
-    """Normalize a track title for comparison by removing version indicators."""
+    """Normalized title (see _normalize_title), cached in TITLE_CACHE."""
+    normalized = TITLE_CACHE.get(title)
+    if normalized is None:
+        normalized = _normalize_title(title)
+        TITLE_CACHE.set(title, normalized)
+    return normalized
+
+
+def _normalize_title(title):
+    """
+    Normalize a track title for comparison by removing version indicators.
+    Most titles have no brackets, dashes or "feat", so they skip the rules entirely,
+    and the rest only run the rules whose text is actually in the title.
+    """
     if not title:
         return ""
-    original = title
     title = title.lower()
-    # Remove common suffixes that indicate versions - ORDER MATTERS (specific before generic)
-    patterns = [
-        # Specific remaster/re-recorded patterns first
-        r'\s*[-–—]\s*re-?recorded.*$',  # " - Re-Recorded" at end
-        r'\s*\(remastered\s+album\s+version\)',
-        r'\s*\(remastered\s+\d+\)',
-        r'\s*\(remaster(ed)?\s*\d*\)',
-        r'\s*[-–—]\s*remaster(ed)?(\s+\d+)?(\s+album\s+version)?',
-        r'\s*[-–—]\s*\d+\s*remaster(ed)?',
-        r'\s*\(remaster(ed)?(\s+\d+)?(\s+album\s+version)?\)',
-        r'\s*\(\d+\s*remaster(ed)?\)',
-        # Album/version indicators
-        r'\s*\(deluxe.*?\)',
-        r'\s*\(expanded.*?\)',
-        r'\s*\(anniversary.*?\)',
-        r'\s*\(bonus track.*?\)',
-        r'\s*\(album version.*?\)',
-        r'\s*\(original.*?\)',
-        r'\s*\(single version.*?\)',
-        r'\s*\(radio edit.*?\)',
-        r'\s*\(explicit.*?\)',
-        r'\s*\(clean.*?\)',
-        r'\s*\(edit\)',
-        r'\s*\(re-?recorded.*?\)',
-        r'\s*\(remix.*?\)',
-        r'\s*[-–—]\s*remix.*$',
-        r'\s*[-–—]\s*live.*$',
-        r'\s*\(live.*?\)',
-        r'\s*\(acoustic.*?\)',
-        r'\s*[-–—]\s*acoustic.*$',
-        r'\s*[-–—]\s*from\s+".*"',
-        r'\s*\(from\s+".*"\)',
-        r'\s*\(from\s+.*?\)',
-        r'\s*[-–—]\s*mono.*$',
-        r'\s*\(mono.*?\)',
-        r'\s*[-–—]\s*stereo.*$',
-        r'\s*\(stereo.*?\)',
-        r'\s*\(super\s+deluxe.*?\)',
-        r'\s*\(special\s+edition.*?\)',
-        r'\s*\(version\)$',
-        # Generic catch-alls LAST
-        r'\s*\([^)]*remaster[^)]*\)',  # Anything with remaster in parens
-        r'\s*\([^)]*version\)',  # Anything ending with version in parens
-        r'\s*\([^)]*edition\)',  # Anything ending with edition in parens
-        r'\s*\([^)]*mix\)',  # Anything ending with mix in parens
-    ]
-    for pattern in patterns:
-        title = re.sub(pattern, '', title, flags=re.IGNORECASE)
+    # Once lowercased, IGNORECASE can only match something other than the literal text
+    # for a few non-ASCII letters (e.g. "ſ" for "s"), so those titles run every rule.
+    check_needs = title.isascii()
+
+    # Every version rule starts at a bracket or dash, and removing text never adds one
+    if '(' in title or '-' in title or '–' in title or '—' in title:
+        for pattern, needs in TITLE_VERSION_RULES:
+            if check_needs and not all(text in title for text in needs):
+                continue
+            title = pattern.sub('', title)
     
     # Remove featuring artists from title
-    title = re.sub(r'\s*(feat\.?|ft\.?|featuring)\s+.*$', '', title, flags=re.IGNORECASE)
-    title = re.sub(r'\s*\((feat\.?|ft\.?|featuring).*?\)', '', title, flags=re.IGNORECASE)
+    if not check_needs or 'ft' in title or 'feat' in title:
+        for pattern in TITLE_FEAT_PATTERNS:
+            title = pattern.sub('', title)
     
     # Remove extra whitespace
     title = ' '.join(title.split())
     return title.strip()
 
 
+if TITLE_CACHE_PATH:
+    load_title_cache(TITLE_CACHE_PATH)
+    # Titles added since the last throttled save
+    atexit.register(save_title_cache, TITLE_CACHE_PATH, force=True)
+
+
 def fuzzy_title_match(title1, title2):
     """Returns similarity ratio between two titles (0.0 to 1.0)."""
     return SequenceMatcher(None, title1, title2).ratio()
@@ -588,22 +1990,17 @@ def duration_within_threshold(duration1, duration2):
     return abs(duration1 - duration2) <= threshold
 
 
-def artists_overlap(artists1, artists2):
-    """Check if there's any artist overlap between two tracks."""
-    if not artists1 or not artists2:
+def artists_overlap(features1, features2):
+    """Check if there's any artist overlap between two tracks (TrackFeatures)."""
+    # Disjoint signatures rule out any shared artist without looking at the IDs
+    if not features1.artist_mask & features2.artist_mask:
         return False
-    ids1 = {a['id'] for a in artists1 if a.get('id')}
-    ids2 = {a['id'] for a in artists2 if a.get('id')}
-    return len(ids1 & ids2) > 0
+    return not set(features1.artist_ids).isdisjoint(features2.artist_ids)
 
 
-def artists_exact_match(artists1, artists2):
-    """Check if artist lists match exactly."""
-    if not artists1 or not artists2:
-        return False
-    ids1 = {a['id'] for a in artists1 if a.get('id')}
-    ids2 = {a['id'] for a in artists2 if a.get('id')}
-    return ids1 == ids2 and len(ids1) > 0
+def artists_exact_match(features1, features2):
+    """Check if two tracks (TrackFeatures) have exactly the same artists."""
+    return bool(features1.artist_ids) and features1.artist_ids == features2.artist_ids
 
 
 def get_isrc(track):
@@ -612,60 +2009,783 @@ def get_isrc(track):
     return external_ids.get('isrc')
 
 
-def calculate_similarity_score(track1, track2):
+class IdInterner:
+    """
+    Maps Spotify IDs to dense ints (0, 1, 2, ...) in first-seen order. One is used per matcher run,
+    so IDs hash and compare as small ints and artist sets fit in tuples and bitmasks.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, spotify_id):
+        interned = self.ids.get(spotify_id)
+        if interned is None:
+            interned = self.ids[spotify_id] = len(self.ids)
+        return interned
+
+
+class TrackFeatures:
+    """
+    Everything the matcher compares about a track, computed once when the track is ingested
+    instead of on every comparison. `track` is the original dict, for reporting.
+    `id` and `artist_ids` are interned through `interner`, so only compare features built with
+    the same one. `artist_ids` is a sorted tuple and `artist_mask` has bit (id % 64) set per artist.
+    """
+
+    __slots__ = ('track', 'id', 'norm_title', 'duration', 'artist_ids', 'artist_mask', 'isrc')
+
+    def __init__(self, track, interner):
+        self.track = track
+        self.id = interner(track.get('id'))
+        self.norm_title = normalize_title(track.get('name', ''))
+        self.duration = track.get('duration_ms')
+        self.artist_ids = tuple(sorted({interner(a['id']) for a in track.get('artists') or [] if a.get('id')}))
+        self.artist_mask = 0
+        for artist_id in self.artist_ids:
+            self.artist_mask |= 1 << (artist_id & 63)
+        self.isrc = get_isrc(track)
+
+
+def similarity_score_bound(features1, features2):
+    """
+    Upper bound on calculate_similarity_score for two tracks with different titles (ISRC aside),
+    from the cheap duration and artist checks alone: a similar title adds at most 25 points.
+    """
+    bound = 25
+    if duration_within_threshold(features1.duration, features2.duration):
+        bound += 30
+    if artists_overlap(features1, features2):
+        bound += 40 if artists_exact_match(features1, features2) else 30
+    return bound
+
+
+def calculate_similarity_score(features1, features2, min_score=0, title_similarity=None, stats=None):
     """
-    Calculate similarity score between two tracks.
+    Calculate similarity score between two tracks (as TrackFeatures).
     Returns (score, reasons) where score >= 80 means duplicate, 40-79 means warning.
+
+    Duration and artists are scored before the title, and the title ratio is only computed
+    when a similar title could still lift the score to `min_score`. Scores below `min_score`
+    may come back lower than the full score. Pass `title_similarity` if the ratio is already known.
+    `stats` (a Counter) collects how many pairs were scored and ratios computed or skipped.
     """
-    score = 0
-    reasons = []
-    
     # Check ISRC first (instant match)
-    isrc1 = get_isrc(track1)
-    isrc2 = get_isrc(track2)
-    if isrc1 and isrc2 and isrc1 == isrc2:
+    if features1.isrc and features2.isrc and features1.isrc == features2.isrc:
         return (100, ["Same ISRC (identical recording)"])
     
+    if stats is not None:
+        stats['pairs_scored'] += 1
+    
+    # Duration and artist checks are cheap, so score them before any string similarity
+    other_score = 0
+    other_reasons = []
+    
+    # Duration comparison
+    dur1 = features1.duration
+    dur2 = features2.duration
+    if duration_within_threshold(dur1, dur2):
+        other_score += 30
+        diff_sec = abs(dur1 - dur2) / 1000 if dur1 and dur2 else 0
+        other_reasons.append(f"Similar duration (±{diff_sec:.1f}s)")
+    
+    # Artist comparison
+    if artists_overlap(features1, features2):
+        other_score += 30
+        other_reasons.append("Shared artist(s)")
+        if artists_exact_match(features1, features2):
+            other_score += 10
+            other_reasons[-1] = "Same artist(s)"
+    
     # Title comparison (either/or, not cumulative)
-    norm_title1 = normalize_title(track1.get('name', ''))
-    norm_title2 = normalize_title(track2.get('name', ''))
+    norm_title1 = features1.norm_title
+    norm_title2 = features2.norm_title
     
     title_score = 0
+    reasons = []
     if norm_title1 and norm_title2:
         if norm_title1 == norm_title2:
             title_score = 40
             reasons.append("Exact title match")
+        elif title_similarity is None and other_score + 25 < min_score:
+            # Even a similar title couldn't reach min_score, so the ratio can't change the outcome
+            if stats is not None:
+                stats['title_ratios_skipped'] += 1
         else:
-            similarity = fuzzy_title_match(norm_title1, norm_title2)
+            similarity = title_similarity
+            if similarity is None:
+                similarity = fuzzy_title_match(norm_title1, norm_title2)
+                if stats is not None:
+                    stats['title_ratios_computed'] += 1
             if similarity >= 0.9:
                 title_score = 25
                 reasons.append(f"Similar title ({similarity:.0%})")
-    score += title_score
-    
-    # Duration comparison
-    dur1 = track1.get('duration_ms')
-    dur2 = track2.get('duration_ms')
-    if duration_within_threshold(dur1, dur2):
-        score += 30
-        diff_sec = abs(dur1 - dur2) / 1000 if dur1 and dur2 else 0
-        reasons.append(f"Similar duration (±{diff_sec:.1f}s)")
-    
-    # Artist comparison
-    artists1 = track1.get('artists', [])
-    artists2 = track2.get('artists', [])
-    if artists_overlap(artists1, artists2):
-        score += 30
-        reasons.append("Shared artist(s)")
-        if artists_exact_match(artists1, artists2):
-            score += 10
-            reasons[-1] = "Same artist(s)"
     
-    return (score, reasons)
+    return (title_score + other_score, reasons + other_reasons)
+
+
+def title_trigrams(title):
+    """Counts of each character trigram in a title."""
+    grams = {}
+    for i in range(len(title) - 2):
+        gram = title[i:i+3]
+        grams[gram] = grams.get(gram, 0) + 1
+    return grams
+
+
+class TitleTrigramIndex:
+    """
+    Character-trigram inverted index over normalized titles, for finding every title whose
+    fuzzy_title_match ratio with a query reaches a threshold without comparing against all of them.
+
+    If two titles of total length T have M matching characters in k matching blocks, they share
+    at least M - 2k trigrams, and k - 1 <= T - 2M (blocks are separated by unmatched characters).
+    So shared >= 5M - 2T - 2, and a ratio 2M/T >= threshold needs
+    2 * shared + 4 >= (5 * threshold - 4) * T. Titles that can't meet that, or whose lengths
+    are too far apart, are skipped. The survivors are checked with the exact ratio.
+    Pass `postings` if they were already built for these titles (see MappedFilterIndex).
+    """
+
+    def __init__(self, titles, postings=None):
+        self.titles = list(titles)
+        self.postings = {} if postings is None else postings  # trigram -> list of (title_index, count)
+        self.by_length = {}  # length -> list of title_index
+        for index, title in enumerate(self.titles):
+            if postings is None:
+                for gram, count in title_trigrams(title).items():
+                    self.postings.setdefault(gram, []).append((index, count))
+            self.by_length.setdefault(len(title), []).append(index)
+
+    def possible_matches(self, query, threshold):
+        """
+        Indexed titles that could have a ratio >= threshold with `query`, in index order.
+        Only the trigram and length bounds are applied, no ratio is computed.
+        """
+        query_length = len(query)
+        gram_weight = 5 * threshold - 4
+        eps = 1e-9
+
+        # Lengths that could reach the threshold: 2 * min(la, lb) / (la + lb) >= threshold
+        allowed_lengths = [
+            length for length in self.by_length
+            if 2 * min(query_length, length) >= threshold * (query_length + length) - eps
+        ]
+        if not allowed_lengths:
+            return []
+
+        if gram_weight <= 0:
+            # Trigrams can't prune at this threshold, check every title of a possible length
+            survivors = [index for length in allowed_lengths for index in self.by_length[length]]
+        else:
+            allowed = set(allowed_lengths)
+            shared = {}
+            for gram, query_count in title_trigrams(query).items():
+                for index, count in self.postings.get(gram, ()):
+                    shared[index] = shared.get(index, 0) + min(query_count, count)
+
+            survivors = [
+                index for index, shared_count in shared.items()
+                if len(self.titles[index]) in allowed
+                and 2 * shared_count + 4 >= gram_weight * (query_length + len(self.titles[index])) - eps
+            ]
+            # Short enough pairs can reach the threshold without sharing any trigram
+            for length in allowed_lengths:
+                if 4 >= gram_weight * (query_length + length) - eps:
+                    survivors.extend(index for index in self.by_length[length] if index not in shared)
+
+        return [self.titles[index] for index in sorted(survivors)]
+
+    def candidates(self, query, threshold):
+        """Returns (title, ratio) for every indexed title with a ratio >= threshold, in index order."""
+        matches = []
+        for title in self.possible_matches(query, threshold):
+            similarity = fuzzy_title_match(query, title)
+            if similarity >= threshold:
+                matches.append((title, similarity))
+        return matches
+
+
+class FilterIndex:
+    """
+    Everything the matcher looks up about the filter corpus, built once per run:
+    each track's features, tracks grouped by normalized title and by ISRC,
+    and a trigram index over the normalized titles.
+    """
+
+    def __init__(self, filter_tracks):
+        self.interner = IdInterner()
+        self.features = [TrackFeatures(track, self.interner) for track in filter_tracks]
+
+        # Build index by normalized title for faster lookup
+        self.by_title = {}
+        for features in self.features:
+            if features.norm_title:
+                if features.norm_title not in self.by_title:
+                    self.by_title[features.norm_title] = []
+                self.by_title[features.norm_title].append(features)
+
+        # Also index by ISRC for instant matches, keeping every track with each ISRC
+        self.by_isrc = {}
+        for features in self.features:
+            if features.isrc:
+                self.by_isrc.setdefault(features.isrc, []).append(features)
+
+        # Titles are indexed in by_title order, so candidates come back in that order
+        self.title_index = TitleTrigramIndex(self.by_title)
+        self._positions = None  # id(features) -> position in self.features, built by position()
+
+    def target_features(self, track):
+        """TrackFeatures for a target track, comparable with this index's features."""
+        return TrackFeatures(track, self.interner)
+
+    def isrc_match(self, target):
+        """
+        The first filter track with the target's ISRC, preferring one with a different ID.
+        Returns None if no filter track shares it.
+        """
+        matches = self.by_isrc.get(target.isrc) if target.isrc else None
+        if not matches:
+            return None
+        return next((features for features in matches if features.id != target.id), matches[0])
+
+    def best_match(self, target, stats=None):
+        """The filter track most similar to `target`, see find_best_filter_match."""
+        return find_best_filter_match(target, self, stats)
+
+    def position(self, features):
+        """Where `features`, one of this index's, is in self.features."""
+        if self._positions is None:
+            self._positions = {id(f): position for position, f in enumerate(self.features)}
+        return self._positions[id(features)]
+
+
+def find_best_filter_match(target, filter_index, stats=None):
+    """
+    Finds the filter track most similar to `target` (TrackFeatures).
+    Returns (best_match, score, reasons), best_match being TrackFeatures or None.
+    Matches scoring under 40 are only found approximately, since they're never reported.
+    """
+    best_match = None
+    best_score = 0
+    best_reasons = []
+
+    # Check ISRC first
+    isrc_match = filter_index.isrc_match(target)
+    if isrc_match is not None:
+        return isrc_match, 100, ["Same ISRC (identical recording)"]
+
+    # Exact normalized title matches
+    for candidate in filter_index.by_title.get(target.norm_title, ()):
+        if candidate.id == target.id:
+            continue  # Skip exact same track
+        score, reasons = calculate_similarity_score(target, candidate, max(best_score + 1, 40), stats=stats)
+        if score > best_score:
+            best_score = score
+            best_match = candidate
+            best_reasons = reasons
+
+    # Also check fuzzy matches. The trigram index only returns titles that can still reach the threshold,
+    # and a title's ratio is only computed once one of its tracks could beat the current best.
+    for norm_title in filter_index.title_index.possible_matches(target.norm_title, 0.85):  # Lower threshold for candidate selection
+        if norm_title == target.norm_title:
+            continue
+        similarity = None
+        for candidate in filter_index.by_title[norm_title]:
+            if candidate.id == target.id:
+                continue  # Skip exact same track
+            min_score = max(best_score + 1, 40)
+            if similarity is None:
+                if similarity_score_bound(target, candidate) < min_score:
+                    if stats is not None:
+                        stats['title_ratios_skipped'] += 1
+                    continue
+                similarity = fuzzy_title_match(target.norm_title, norm_title)
+                if stats is not None:
+                    stats['title_ratios_computed'] += 1
+                if similarity < 0.85:
+                    break  # Not a candidate title after all
+            score, reasons = calculate_similarity_score(target, candidate, min_score, similarity, stats)
+            if score > best_score:
+                best_score = score
+                best_match = candidate
+                best_reasons = reasons
+
+    return best_match, best_score, best_reasons
+
+
+class NumpyFilterIndex(FilterIndex):
+    """
+    FilterIndex that also keeps the filter tracks as arrays, grouped by normalized title
+    in by_title order: durations, track IDs and artist IDs (flattened, one slice per row).
+    best_match scores one target against all of its candidates at once and only runs the
+    title ratio for titles that could still produce the best match, with the same result
+    as find_best_filter_match.
+    """
+
+    def __init__(self, filter_tracks):
+        super().__init__(filter_tracks)
+
+        rows = [features for group in self.by_title.values() for features in group]
+        self.row_features = rows
+
+        self.title_starts = np.zeros(len(self.by_title), dtype=np.int64)
+        self.title_lengths = np.zeros(len(self.by_title), dtype=np.int64)
+        position = 0
+        for title_id, group in enumerate(self.by_title.values()):
+            self.title_starts[title_id] = position
+            self.title_lengths[title_id] = len(group)
+            position += len(group)
+        self.title_ids = {title: title_id for title_id, title in enumerate(self.by_title)}
+
+        self.durations = np.array([features.duration or 0 for features in rows], dtype=np.int64)
+        self.row_track_ids = np.array([features.id for features in rows], dtype=np.int64)
+        artist_flat = []
+        self.artist_starts = np.zeros(len(rows), dtype=np.int64)
+        self.artist_counts = np.zeros(len(rows), dtype=np.int64)
+        for row, features in enumerate(rows):
+            self.artist_starts[row] = len(artist_flat)
+            self.artist_counts[row] = len(features.artist_ids)
+            artist_flat.extend(features.artist_ids)
+        self.artist_flat = np.array(artist_flat, dtype=np.int64)
+
+    @staticmethod
+    def _expand(starts, lengths):
+        """Concatenation of range(start, start + length) for each pair, plus which pair each came from."""
+        total = int(lengths.sum())
+        offsets = np.cumsum(lengths) - lengths
+        owners = np.repeat(np.arange(len(lengths)), lengths)
+        return np.arange(total) - offsets[owners] + starts[owners], owners
+
+    def _base_scores(self, target, rows):
+        """Duration and artist points of every row against the target."""
+        scores = np.zeros(len(rows), dtype=np.int64)
+
+        if target.duration:
+            durations = self.durations[rows]
+            threshold = np.maximum(10000.0, np.maximum(durations, target.duration) * 0.03)
+            duration_ok = (durations != 0) & (np.abs(durations - target.duration) <= threshold)
+            scores += 30 * duration_ok
+
+        if target.artist_ids:
+            positions, owners = self._expand(self.artist_starts[rows], self.artist_counts[rows])
+            hits = np.isin(self.artist_flat[positions], target.artist_ids)
+            overlap = np.bincount(owners[hits], minlength=len(rows))
+            exact = (overlap == len(target.artist_ids)) & (self.artist_counts[rows] == len(target.artist_ids))
+            scores += 30 * (overlap > 0) + 10 * exact
+
+        return scores
+
+    def best_match(self, target, stats=None):
+        # Check ISRC first
+        isrc_match = self.isrc_match(target)
+        if isrc_match is not None:
+            return isrc_match, 100, ["Same ISRC (identical recording)"]
+
+        # Candidate titles in the order the serial matcher visits them: exact title, then fuzzy titles
+        exact_title_id = self.title_ids.get(target.norm_title)
+        fuzzy_title_ids = [
+            self.title_ids[title]
+            for title in self.title_index.possible_matches(target.norm_title, 0.85)  # Lower threshold for candidate selection
+            if title != target.norm_title
+        ]
+        title_ids = np.array(([exact_title_id] if exact_title_id is not None else []) + fuzzy_title_ids, dtype=np.int64)
+        if not len(title_ids):
+            return None, 0, []
+
+        lengths = self.title_lengths[title_ids]
+        rows, owners = self._expand(self.title_starts[title_ids], lengths)
+        scores = self._base_scores(target, rows)
+        if stats is not None:
+            stats['pairs_scored'] += len(rows)
+
+        # Never match a track against itself
+        scores[self.row_track_ids[rows] == target.id] = -1000
+
+        # Exact title rows get 40 title points
+        first_fuzzy = 0
+        if exact_title_id is not None:
+            first_fuzzy = int(lengths[0])
+            scores[:first_fuzzy] += 40
+        best_exact = int(scores[:first_fuzzy].max()) if first_fuzzy else 0
+
+        if fuzzy_title_ids:
+            # A fuzzy title's ratio only matters if one of its tracks, with a similar title,
+            # could beat the exact title matches and reach the warning floor
+            fuzzy_scores = scores[first_fuzzy:]
+            fuzzy_owners = owners[first_fuzzy:] - (1 if first_fuzzy else 0)
+            title_offsets = np.cumsum(lengths[-len(fuzzy_title_ids):]) - lengths[-len(fuzzy_title_ids):]
+            title_bounds = np.maximum.reduceat(fuzzy_scores, title_offsets) + 25
+            floor = max(best_exact + 1, 40)
+
+            title_points = np.full(len(fuzzy_title_ids), -1000, dtype=np.int64)
+            for index in np.flatnonzero(title_bounds >= floor):
+                similarity = fuzzy_title_match(target.norm_title, self.title_index.titles[fuzzy_title_ids[index]])
+                if similarity >= 0.85:
+                    title_points[index] = 25 if similarity >= 0.9 else 0
+            if stats is not None:
+                computed = int((title_bounds >= floor).sum())
+                stats['title_ratios_computed'] += computed
+                stats['title_ratios_skipped'] += len(fuzzy_title_ids) - computed
+            fuzzy_scores += title_points[fuzzy_owners]
+
+        # argmax picks the first of equal scores, like the serial scan
+        best_row = int(np.argmax(scores))
+        if scores[best_row] < 40:
+            return None, 0, []
+        best_match = self.row_features[rows[best_row]]
+        score, reasons = calculate_similarity_score(target, best_match)
+        return best_match, score, reasons
+
+
+def build_filter_index(filter_tracks, backend=None):
+    """Returns the FilterIndex for the configured MATCHER_BACKEND (or `backend`)."""
+    backend = backend or MATCHER_BACKEND
+    if backend == "numpy":
+        if np is not None:
+            return NumpyFilterIndex(filter_tracks)
+        print("MATCHER_BACKEND=numpy but numpy isn't installed, using the python matcher.")
+    return FilterIndex(filter_tracks)
+
+
+# Written at the start of every filter index file, bump it when the layout changes
+FILTER_INDEX_MAGIC = b"SFIDX001"
+
+
+def _align8(offset):
+    """`offset` rounded up to a multiple of 8, so int64 arrays start aligned."""
+    return (offset + 7) & ~7
+
+
+def filter_index_path(corpus_version):
+    """Where the filter index of a corpus (see FilterCorpus.version) is kept in FILTER_INDEX_DIR."""
+    key = f"{FILTER_INDEX_MAGIC.decode()}:{TITLE_RULES_VERSION}:{corpus_version}"
+    return os.path.join(FILTER_INDEX_DIR, hashlib.sha1(key.encode()).hexdigest() + ".idx")
+
+
+def save_filter_index(filter_index, path):
+    """
+    Writes a built filter index to `path` in the layout MappedFilterIndex reads:
+    the magic, the header length (8 bytes, little-endian), a JSON header, then int64 arrays,
+    a JSON document of the strings and each track's JSON, at the offsets the header gives.
+    Rows are the filter tracks grouped by normalized title in by_title order (as in
+    NumpyFilterIndex), followed by the tracks without a title.
+    Then drops the least recently used index files beyond FILTER_INDEX_MAX_FILES.
+    """
+    titles = list(filter_index.by_title)
+    rows = [features for group in filter_index.by_title.values() for features in group]
+    rows += [features for features in filter_index.features if not features.norm_title]
+    row_of = {id(features): row for row, features in enumerate(rows)}
+    title_of = {title: title_id for title_id, title in enumerate(titles)}
+    isrcs = list(filter_index.by_isrc)
+    isrc_of = {isrc: isrc_id for isrc_id, isrc in enumerate(isrcs)}
+    postings = filter_index.title_index.postings
+    grams = list(postings)
+
+    arrays = {name: array('q') for name in (
+        'row_track_ids', 'row_titles', 'row_isrcs', 'durations', 'artist_starts', 'artist_counts', 'artist_flat',
+        'title_starts', 'title_lengths', 'isrc_starts', 'isrc_lengths', 'isrc_rows',
+        'gram_starts', 'gram_lengths', 'posting_titles', 'posting_counts', 'track_offsets',
+    )}
+    track_data = bytearray()
+    for features in rows:
+        arrays['row_track_ids'].append(features.id)
+        arrays['row_titles'].append(title_of.get(features.norm_title, -1))
+        arrays['row_isrcs'].append(isrc_of[features.isrc] if features.isrc else -1)
+        arrays['durations'].append(features.duration or 0)
+        arrays['artist_starts'].append(len(arrays['artist_flat']))
+        arrays['artist_counts'].append(len(features.artist_ids))
+        arrays['artist_flat'].extend(features.artist_ids)
+        arrays['track_offsets'].append(len(track_data))
+        track_data += json.dumps(features.track, separators=(',', ':')).encode()
+    arrays['track_offsets'].append(len(track_data))
+    for group in filter_index.by_title.values():
+        arrays['title_starts'].append(row_of[id(group[0])])
+        arrays['title_lengths'].append(len(group))
+    for group in filter_index.by_isrc.values():
+        arrays['isrc_starts'].append(len(arrays['isrc_rows']))
+        arrays['isrc_lengths'].append(len(group))
+        arrays['isrc_rows'].extend(row_of[id(features)] for features in group)
+    for gram in grams:
+        arrays['gram_starts'].append(len(arrays['posting_titles']))
+        arrays['gram_lengths'].append(len(postings[gram]))
+        for title_id, count in postings[gram]:
+            arrays['posting_titles'].append(title_id)
+            arrays['posting_counts'].append(count)
+
+    strings = json.dumps({'ids': list(filter_index.interner.ids), 'titles': titles, 'isrcs': isrcs, 'grams': grams}).encode()
+
+    # Section offsets are relative to the end of the header
+    sections = []
+    header = {'byteorder': sys.byteorder, 'arrays': {}}
+    offset = 0
+    for name, values in arrays.items():
+        header['arrays'][name] = [offset, len(values)]
+        sections.append(values.tobytes())
+        offset += 8 * len(values)
+    header['strings'] = [offset, len(strings)]
+    sections.append(strings)
+    offset = _align8(offset + len(strings))
+    header['tracks'] = [offset, len(track_data)]
+    header_bytes = json.dumps(header).encode()
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_file(path, 'wb') as f:
+            f.write(FILTER_INDEX_MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+            f.write(bytes(_align8(f.tell()) - f.tell()))
+            for section in sections:
+                f.write(section)
+            f.write(bytes(_align8(f.tell()) - f.tell()))
+            f.write(track_data)
+    except OSError as e:
+        print(f"Couldn't save the filter index to {path}: {e}")
+        return
+
+    try:
+        index_files = [entry for entry in os.scandir(os.path.dirname(path)) if entry.name.endswith(".idx")]
+        index_files.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in index_files[FILTER_INDEX_MAX_FILES:]:
+            os.remove(entry.path)
+    except OSError as e:
+        print(f"Couldn't prune the filter indexes in {os.path.dirname(path)}: {e}")
+
+
+class _MappedGroups(Mapping):
+    """
+    Read-only {key: list of TrackFeatures} over a MappedFilterIndex, like by_title and by_isrc.
+    Group i is rows[starts[i]:starts[i] + lengths[i]] (or that range itself when `rows` is None).
+    Each group's list is built the first time it's looked up and kept for the next lookups.
+    """
+
+    def __init__(self, index, keys, starts, lengths, rows=None):
+        self.index = index
+        self.keys_in_order = keys
+        self.ids = {key: group_id for group_id, key in enumerate(keys)}
+        self.starts = starts
+        self.lengths = lengths
+        self.rows = rows
+        self._groups = {}
+
+    def __getitem__(self, key):
+        group = self._groups.get(key)
+        if group is None:
+            group_id = self.ids[key]
+            start = self.starts[group_id]
+            end = start + self.lengths[group_id]
+            rows = range(start, end) if self.rows is None else self.rows[start:end]
+            group = self._groups[key] = [self.index.features[row] for row in rows]
+        return group
+
+    def __iter__(self):
+        return iter(self.keys_in_order)
+
+    def __len__(self):
+        return len(self.keys_in_order)
+
+
+class _MappedPostings(Mapping):
+    """
+    Read-only trigram -> list of (title_index, count) over a MappedFilterIndex's posting arrays.
+    Like _MappedGroups, each list is built on its first lookup and kept.
+    """
+
+    def __init__(self, grams, starts, lengths, titles, counts):
+        self.grams = grams
+        self.ids = {gram: gram_id for gram_id, gram in enumerate(grams)}
+        self.starts = starts
+        self.lengths = lengths
+        self.titles = titles
+        self.counts = counts
+        self._postings = {}
+
+    def __getitem__(self, gram):
+        postings = self._postings.get(gram)
+        if postings is None:
+            gram_id = self.ids[gram]
+            start = self.starts[gram_id]
+            end = start + self.lengths[gram_id]
+            postings = self._postings[gram] = list(zip(self.titles[start:end], self.counts[start:end]))
+        return postings
+
+    def __iter__(self):
+        return iter(self.grams)
+
+    def __len__(self):
+        return len(self.grams)
+
+
+class _MappedFeatures(Sequence):
+    """A MappedFilterIndex's rows as TrackFeatures, each built the first time it's looked at."""
 
+    def __init__(self, index):
+        self.index = index
 
-def find_duplicates_and_warnings(target_tracks, filter_tracks):
+    def __getitem__(self, row):
+        return self.index.row_features_at(int(row))
+
+    def __len__(self):
+        return len(self.index.row_track_ids)
+
+
+class MappedFilterIndex(FilterIndex):
+    """
+    FilterIndex read through mmap from a file written by save_filter_index, so nothing is built:
+    the arrays are used in place, and a row's TrackFeatures (and its track dict) are only made
+    when the matcher looks at it. `features` is in row order rather than corpus order.
+    Pickles as its path, so worker processes map the same file and share its pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self._map)
+        if bytes(data[:8]) != FILTER_INDEX_MAGIC:
+            raise ValueError("not a filter index file")
+        header_length = int.from_bytes(data[8:16], 'little')
+        header = json.loads(bytes(data[16:16 + header_length]))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError("filter index was written with a different byte order")
+        base = _align8(16 + header_length)
+
+        # A short or damaged file must fail here, not as an IndexError halfway through matching
+        sections = [(offset, 8 * count) for offset, count in header['arrays'].values()]
+        sections += [header['strings'], header['tracks']]
+        if any(offset < 0 or length < 0 or base + offset + length > len(self._map) for offset, length in sections):
+            raise ValueError("filter index file is truncated")
+
+        # Every array becomes an attribute of the same name, viewed straight from the file
+        for name, (offset, count) in header['arrays'].items():
+            setattr(self, name, data[base + offset:base + offset + 8 * count].cast('q'))
+        rows = len(self.row_track_ids)
+        row_arrays = (self.row_titles, self.row_isrcs, self.durations, self.artist_starts, self.artist_counts)
+        consistent = all(len(values) == rows for values in row_arrays) and len(self.track_offsets) == rows + 1
+        if not consistent or self.track_offsets[rows] != header['tracks'][1]:
+            raise ValueError("filter index arrays don't match its rows")
+        offset, length = header['strings']
+        strings = json.loads(bytes(data[base + offset:base + offset + length]))
+        offset, length = header['tracks']
+        self._track_data = data[base + offset:base + offset + length]
+
+        self.interner = IdInterner()
+        self.interner.ids = {spotify_id: interned for interned, spotify_id in enumerate(strings['ids'])}
+        self.titles = strings['titles']
+        self.isrcs = strings['isrcs']
+        self._row_features = {}  # row -> TrackFeatures, for the rows looked at so far
+        self._positions = {}  # id(features) -> row
+
+        self.features = _MappedFeatures(self)
+        self.by_title = _MappedGroups(self, self.titles, self.title_starts, self.title_lengths)
+        self.title_ids = self.by_title.ids
+        self.by_isrc = _MappedGroups(self, self.isrcs, self.isrc_starts, self.isrc_lengths, self.isrc_rows)
+        self.title_index = TitleTrigramIndex(self.titles, _MappedPostings(
+            strings['grams'], self.gram_starts, self.gram_lengths, self.posting_titles, self.posting_counts
+        ))
+
+    def __reduce__(self):
+        return type(self), (self.path,)
+
+    def row_features_at(self, row):
+        """TrackFeatures of a row, as FilterIndex would have built them."""
+        features = self._row_features.get(row)
+        if features is None:
+            features = TrackFeatures.__new__(TrackFeatures)
+            features.track = json.loads(bytes(self._track_data[self.track_offsets[row]:self.track_offsets[row + 1]]))
+            # int() since MappedNumpyFilterIndex swaps some arrays for numpy ones
+            features.id = int(self.row_track_ids[row])
+            title_id = self.row_titles[row]
+            features.norm_title = self.titles[title_id] if title_id >= 0 else ""
+            features.duration = int(self.durations[row]) or None
+            start = int(self.artist_starts[row])
+            features.artist_ids = tuple(int(artist_id) for artist_id in self.artist_flat[start:start + int(self.artist_counts[row])])
+            features.artist_mask = 0
+            for artist_id in features.artist_ids:
+                features.artist_mask |= 1 << (artist_id & 63)
+            isrc_id = self.row_isrcs[row]
+            features.isrc = self.isrcs[isrc_id] if isrc_id >= 0 else None
+            self._row_features[row] = features
+            self._positions[id(features)] = row
+        return features
+
+    def position(self, features):
+        return self._positions[id(features)]
+
+
+class MappedNumpyFilterIndex(MappedFilterIndex, NumpyFilterIndex):
+    """MappedFilterIndex scored like NumpyFilterIndex, with numpy arrays over the mapped ones."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.row_features = self.features
+        for name in ('durations', 'row_track_ids', 'artist_starts', 'artist_counts', 'artist_flat',
+                     'title_starts', 'title_lengths'):
+            setattr(self, name, np.frombuffer(getattr(self, name), dtype=np.int64))
+
+
+def open_filter_index(path, backend=None):
+    """The filter index saved at `path`, mapped for the configured MATCHER_BACKEND (or `backend`), or None."""
+    backend = backend or MATCHER_BACKEND
+    index_class = MappedNumpyFilterIndex if backend == "numpy" and np is not None else MappedFilterIndex
+    try:
+        filter_index = index_class(path)
+        os.utime(path)  # Keeps it from being pruned as least recently used
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Couldn't open the filter index {path}: {e}")
+        return None
+    return filter_index
+
+
+# Filter index of a matcher worker process, set by _init_match_worker
+_worker_filter_index = None
+
+
+def _init_match_worker(filter_index):
+    """Process pool initializer: keeps the filter index for every chunk this worker matches."""
+    global _worker_filter_index
+    _worker_filter_index = filter_index
+
+
+def _match_chunk(target_tracks):
+    """
+    Matches a chunk of target tracks in a worker process. Returns (results, stats), with one
+    (position of the best match in filter_index.features or None, score, reasons) per track.
+    """
+    stats = Counter()
+    results = []
+    for target_track in target_tracks:
+        best_match, score, reasons = _worker_filter_index.best_match(_worker_filter_index.target_features(target_track), stats)
+        results.append((_worker_filter_index.position(best_match) if best_match else None, score, reasons))
+    return results, stats
+
+
+def match_in_processes(target_tracks, filter_index, processes, stats=None):
+    """
+    Runs filter_index.best_match for every target track on a pool of worker processes.
+    Returns (best_match, score, reasons) per track, in the order given.
+    """
+    chunks = [target_tracks[i:i + MATCHER_CHUNK_SIZE] for i in range(0, len(target_tracks), MATCHER_CHUNK_SIZE)]
+    matches = []
+    with ProcessPoolExecutor(processes, initializer=_init_match_worker, initargs=(filter_index,)) as pool:
+        for chunk_results, chunk_stats in pool.map(_match_chunk, chunks):
+            for position, score, reasons in chunk_results:
+                best_match = filter_index.features[position] if position is not None else None
+                matches.append((best_match, score, reasons))
+            if stats is not None:
+                stats.update(chunk_stats)
+    return matches
+
+
+def find_duplicates_and_warnings(target_tracks, filter_tracks, filter_index=None, stats=None, processes=None,
+                                 isrc_matches=None):
     """
     Find duplicates and potential duplicates between target and filter playlists.
+    Targets sharing an ISRC with a filter track are settled in one pass before any fuzzy matching.
+    Pass `isrc_matches` ({target track ID: filter track}) if that join was already done elsewhere.
+    Pass a prebuilt `filter_index` to skip building one from `filter_tracks`,
+    and a Counter as `stats` to collect matcher counters.
+    With more than one of `processes` (default MATCHER_PROCESSES), targets are matched in worker processes.
     
     Returns:
         duplicates: list of (target_track, matching_track, score, reasons)
@@ -674,133 +2794,192 @@ def find_duplicates_and_warnings(target_tracks, filter_tracks):
     duplicates = []
     warnings = []
     
-    # Build index by normalized title for faster lookup
-    filter_by_title = {}
-    for track in filter_tracks:
-        norm_title = normalize_title(track.get('name', ''))
-        if norm_title:
-            if norm_title not in filter_by_title:
-                filter_by_title[norm_title] = []
-            filter_by_title[norm_title].append(track)
+    if filter_index is None:
+        filter_index = build_filter_index(filter_tracks)
     
-    # Also index by ISRC for instant matches
-    filter_by_isrc = {}
-    for track in filter_tracks:
-        isrc = get_isrc(track)
-        if isrc:
-            filter_by_isrc[isrc] = track
+    valid_targets = [track for track in target_tracks if track and track.get('id')]
+    target_features = [filter_index.target_features(track) for track in valid_targets]
+    
+    # ISRC hash join: targets sharing an ISRC with a filter track are duplicates, no fuzzy work needed
+    isrc_joined = {}  # position in valid_targets -> filter track
+    for position, target in enumerate(target_features):
+        if isrc_matches is not None:
+            match = isrc_matches.get(valid_targets[position]['id'])
+        else:
+            match = filter_index.isrc_match(target)
+            match = match.track if match is not None else None
+        if match is not None:
+            isrc_joined[position] = match
+    if stats is not None:
+        stats['isrc_joined'] += len(isrc_joined)
+    
+    processes = MATCHER_PROCESSES if processes is None else processes
+    fuzzy_positions = [position for position in range(len(valid_targets)) if position not in isrc_joined]
+    parallel_matches = None
+    if processes > 1 and len(fuzzy_positions) > MATCHER_CHUNK_SIZE:
+        # Match every remaining target in worker processes up front, then use the results in order below
+        fuzzy_targets = [valid_targets[position] for position in fuzzy_positions]
+        parallel_matches = dict(zip(fuzzy_positions, match_in_processes(fuzzy_targets, filter_index, processes, stats)))
     
     seen_target_ids = set()  # Track which target songs we've already matched
     
-    for target_track in target_tracks:
-        if not target_track or not target_track.get('id'):
-            continue
+    for position, target_track in enumerate(valid_targets):
         if target_track['id'] in seen_target_ids:
             continue
-            
-        target_isrc = get_isrc(target_track)
-        target_norm_title = normalize_title(target_track.get('name', ''))
         
-        best_match = None
-        best_score = 0
-        best_reasons = []
+        if position in isrc_joined:
+            duplicates.append((target_track, isrc_joined[position], 100, ["Same ISRC (identical recording)"]))
+            seen_target_ids.add(target_track['id'])
+            continue
         
-        # Check ISRC first
-        if target_isrc and target_isrc in filter_by_isrc:
-            match_track = filter_by_isrc[target_isrc]
-            best_match = match_track
-            best_score = 100
-            best_reasons = ["Same ISRC (identical recording)"]
+        if parallel_matches is not None:
+            best_match, best_score, best_reasons = parallel_matches[position]
         else:
-            # Check tracks with similar titles
-            candidates = []
-            
-            # Exact normalized title matches
-            if target_norm_title in filter_by_title:
-                candidates.extend(filter_by_title[target_norm_title])
-            
-            # Also check fuzzy matches (this is slower but catches more)
-            for norm_title, tracks in filter_by_title.items():
-                if norm_title != target_norm_title:
-                    similarity = fuzzy_title_match(target_norm_title, norm_title)
-                    if similarity >= 0.85:  # Lower threshold for candidate selection
-                        candidates.extend(tracks)
-            
-            # Score each candidate
-            for candidate in candidates:
-                if candidate.get('id') == target_track.get('id'):
-                    continue  # Skip exact same track
-                score, reasons = calculate_similarity_score(target_track, candidate)
-                if score > best_score:
-                    best_score = score
-                    best_match = candidate
-                    best_reasons = reasons
+            best_match, best_score, best_reasons = filter_index.best_match(target_features[position], stats)
         
         if best_match:
             if best_score >= 80:
-                duplicates.append((target_track, best_match, best_score, best_reasons))
+                duplicates.append((target_track, best_match.track, best_score, best_reasons))
                 seen_target_ids.add(target_track['id'])
             elif best_score >= 40:
-                warnings.append((target_track, best_match, best_score, best_reasons))
+                warnings.append((target_track, best_match.track, best_score, best_reasons))
     
     return duplicates, warnings
 
 
-def find_internal_duplicates(tracks):
+class UnionFind:
+    """Disjoint sets over 0..size-1. The root of each set is its smallest member."""
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item1, item2):
+        """Merges the sets of both items. Returns False if they were already in the same set."""
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 == root2:
+            return False
+        if root2 < root1:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        return True
+
+
+def artist_block_duplicates(block, stats=None):
+    """
+    Near-duplicate pairs among tracks sharing an artist. `block` is a list of (position, TrackFeatures)
+    in playlist order. A duplicate (80+ points) needs a title at least 90% similar, so each track is only
+    compared with the tracks that started a cluster so far under a similar title, found through a trigram
+    index over the block's titles. A popular title costs one comparison per distinct version, not per pair.
+    Returns list of (position, earlier position, score, reasons)
+    """
+    title_index = TitleTrigramIndex(dict.fromkeys(features.norm_title for _, features in block))
+    similar_titles = {}  # norm title -> [(similar norm title, ratio)]
+    representatives = {}  # norm title -> block indices of the tracks that started a cluster
+    pairs = []
+    
+    for index, (position, features) in enumerate(block):
+        title = features.norm_title
+        if title not in similar_titles:
+            similar_titles[title] = title_index.candidates(title, 0.9)
+        candidates = sorted(
+            (other, similarity)
+            for similar_title, similarity in similar_titles[title]
+            for other in representatives.get(similar_title, ())
+        )
+        
+        for other, similarity in candidates:
+            other_position, other_features = block[other]
+            if other_features.id == features.id:
+                continue
+            score, reasons = calculate_similarity_score(other_features, features, 80, similarity, stats)
+            if score >= 80:
+                pairs.append((position, other_position, score, reasons))
+                break
+        else:
+            representatives.setdefault(title, []).append(index)
+    
+    return pairs
+
+
+def _artist_blocks_chunk(blocks):
+    """artist_block_duplicates for a chunk of blocks in a worker process."""
+    stats = Counter()
+    return [artist_block_duplicates(block, stats) for block in blocks], stats
+
+
+def find_internal_duplicates(tracks, stats=None, processes=None):
     """
     Find duplicates within a single playlist.
     Returns list of (track_to_remove, original_track, score, reasons)
+
+    Tracks with the same ISRC, or scoring 80+ against each other, are merged into clusters with
+    union-find. The earliest track of each cluster is kept and the rest are returned in playlist order.
+    With more than one of `processes` (default MATCHER_PROCESSES), artist blocks are compared in worker processes.
     """
-    duplicates = []
-    dominated_ids = set()  # Tracks that are duplicates of something else
+    interner = IdInterner()
+    features_list = [TrackFeatures(track, interner) for track in tracks if track and track.get('id')]
+    union_find = UnionFind(len(features_list))
+    links = {}  # position -> (linked position, score, reasons), the first link found for each track
+    
+    def link(position1, position2, score, reasons):
+        if union_find.union(position1, position2):
+            links.setdefault(position1, (position2, score, reasons))
+            links.setdefault(position2, (position1, score, reasons))
     
     # Build index
-    by_title = {}
     by_isrc = {}
-    for track in tracks:
-        if not track or not track.get('id'):
-            continue
-        norm_title = normalize_title(track.get('name', ''))
-        if norm_title:
-            if norm_title not in by_title:
-                by_title[norm_title] = []
-            by_title[norm_title].append(track)
-        isrc = get_isrc(track)
-        if isrc:
-            if isrc not in by_isrc:
-                by_isrc[isrc] = []
-            by_isrc[isrc].append(track)
+    by_artist = {}
+    for position, features in enumerate(features_list):
+        if features.isrc:
+            by_isrc.setdefault(features.isrc, []).append(position)
+        if features.norm_title:
+            for artist_id in features.artist_ids:
+                by_artist.setdefault(artist_id, []).append((position, features))
     
     # Check ISRC duplicates first
-    for isrc, isrc_tracks in by_isrc.items():
-        if len(isrc_tracks) > 1:
-            # Keep the first one, mark others as duplicates
-            original = isrc_tracks[0]
-            for dup in isrc_tracks[1:]:
-                if dup['id'] not in dominated_ids:
-                    duplicates.append((dup, original, 100, ["Same ISRC (identical recording)"]))
-                    dominated_ids.add(dup['id'])
+    for isrc_positions in by_isrc.values():
+        for position in isrc_positions[1:]:
+            link(position, isrc_positions[0], 100, ["Same ISRC (identical recording)"])
     
-    # Check title-based duplicates
-    for norm_title, title_tracks in by_title.items():
-        if len(title_tracks) <= 1:
+    # Then near-duplicates, which always share an artist
+    blocks = [block for block in by_artist.values() if len(block) > 1]
+    processes = MATCHER_PROCESSES if processes is None else processes
+    if processes > 1 and len(blocks) > MATCHER_CHUNK_SIZE:
+        chunks = [blocks[i:i + MATCHER_CHUNK_SIZE] for i in range(0, len(blocks), MATCHER_CHUNK_SIZE)]
+        block_pairs = []
+        with ProcessPoolExecutor(processes) as pool:
+            for chunk_pairs, chunk_stats in pool.map(_artist_blocks_chunk, chunks):
+                block_pairs.extend(chunk_pairs)
+                if stats is not None:
+                    stats.update(chunk_stats)
+    else:
+        block_pairs = [artist_block_duplicates(block, stats) for block in blocks]
+    
+    # Clusters are the connected components of all links, whatever order they're merged in
+    for pairs in block_pairs:
+        for position, other_position, score, reasons in pairs:
+            link(position, other_position, score, reasons)
+    
+    duplicates = []
+    for position, features in enumerate(features_list):
+        root = union_find.find(position)
+        if root == position:
             continue
-        
-        # Compare each pair
-        for i, track1 in enumerate(title_tracks):
-            if track1['id'] in dominated_ids:
-                continue
-            for track2 in title_tracks[i+1:]:
-                if track2['id'] in dominated_ids:
-                    continue
-                if track1['id'] == track2['id']:
-                    continue
-                    
-                score, reasons = calculate_similarity_score(track1, track2)
-                if score >= 80:
-                    # Keep track1, remove track2
-                    duplicates.append((track2, track1, score, reasons))
-                    dominated_ids.add(track2['id'])
+        original = features_list[root]
+        score, reasons = calculate_similarity_score(original, features)
+        if score < 80:
+            # Only linked to the kept track through other duplicates, so report its own match
+            linked_position, score, reasons = links[position]
+            original = features_list[linked_position]
+        duplicates.append((features.track, original.track, score, reasons))
     
     return duplicates
 
@@ -1310,6 +3489,12 @@ HTML_RESULTS_PAGE = """
                 <li>{{ log }}</li>
                 {% endfor %}
             </ul>
+            <h4>Matcher Stats:</h4>
+            <ul class="song-list" style="font-family: monospace; font-size: 0.8rem;">
+                {% for stat in results.matcher_stats %}
+                <li>{{ stat }}</li>
+                {% endfor %}
+            </ul>
         </div>
         {% endif %}
     </div>
@@ -0,0 +1,429 @@
+"""
+Local stand-in for the parts of the Spotify Web API this app uses, for exercising
+run_filter, index() and the removal path (and benchmarking them) without a live account.
+
+Run it, then point the app at it:
+
+    python fake_spotify.py --port 8888 --generate 20x2000 --liked 10000 --latency-ms 80
+    SPOTIFY_API_URL=http://127.0.0.1:8888/v1/ SPOTIFY_ACCOUNTS_URL=http://127.0.0.1:8888 python app.py
+
+Logging in goes through the fake /authorize, which redirects straight back with a code.
+
+Endpoints: /authorize, /api/token, /v1/me, /v1/me/playlists, /v1/me/tracks, /v1/tracks,
+/v1/playlists/<id> and /v1/playlists/<id>/tracks (also /items) for GET and DELETE.
+
+Options:
+    --library FILE        Library fixture to serve (see LIBRARY FORMAT below).
+    --generate PxN        Generate P playlists of N tracks instead (drawn from a shared pool).
+    --liked N             Number of Liked Songs in a generated library.
+    --latency-ms MS       Added to every response (+/- 25% jitter).
+    --rate-limit P        Fraction of API requests answered with a 429 ...
+    --retry-after S       ... carrying this Retry-After.
+    --replay FILE         Serve recorded exchanges (SPOTIFY_RECORD_PATH in app.py) when
+                          the method, path and query match, the library otherwise.
+    --save-library FILE   Write the (generated) library out, to reuse as a fixture.
+
+LIBRARY FORMAT:
+    {
+      "user": {"id": ..., "display_name": ..., "country": "AU"},
+      "tracks": {"<track id>": {full track object, optionally "available_markets": [...]}},
+      "playlists": {"<playlist id>": {"name": ..., "images": [...], "snapshot_id": ...,
+                                      "items": ["<track id>", ...]}},
+      "saved_tracks": [{"added_at": "2024-01-01T00:00:00Z", "track": "<track id>"}, ...]
+    }
+Tracks without "available_markets" are playable everywhere. `is_playable` is only
+returned when the request has a `market`, like the real API. API reads carry an ETag,
+and a request whose If-None-Match matches it gets an empty 304.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import string
+import threading
+import time
+from flask import Flask, jsonify, redirect, request
+
+fake = Flask(__name__)
+# spotipy calls some endpoints with a trailing slash (e.g. "me/")
+fake.url_map.strict_slashes = False
+
+# --- SERVER STATE ---
+LIBRARY = {'user': {}, 'tracks': {}, 'playlists': {}, 'saved_tracks': []}
+OPTIONS = {'latency_ms': 0, 'rate_limit': 0.0, 'retry_after': 1}
+RECORDED = {}  # (method, path, query) -> list of recorded responses
+STATS = {'requests': 0, 'rate_limited': 0, 'replayed': 0, 'not_modified': 0}
+LOCK = threading.Lock()
+
+
+# --- FIELD FILTERS ---
+
+def parse_fields(spec):
+    """
+    Parses a Spotify `fields` filter into a nested dict, e.g.
+    "items(track(id,name)),total" -> {'items': {'track': {'id': None, 'name': None}}, 'total': None}.
+    Dotted paths ("tracks.total") are treated like parentheses.
+    """
+    position = 0
+
+    def parse_group():
+        nonlocal position
+        group = {}
+        while position < len(spec):
+            match = re.match(r'[A-Za-z0-9_.]+', spec[position:])
+            if not match:
+                raise ValueError(f"Bad fields filter at {position}: {spec!r}")
+            path = match.group(0).split('.')
+            position += len(match.group(0))
+            children = None
+            if position < len(spec) and spec[position] == '(':
+                position += 1
+                children = parse_group()
+                position += 1  # ')'
+            node = group
+            for key in path[:-1]:
+                node = node.setdefault(key, {}) or {}
+            node[path[-1]] = children
+            if position < len(spec) and spec[position] == ',':
+                position += 1
+            elif position < len(spec) and spec[position] == ')':
+                break
+        return group
+
+    return parse_group()
+
+
+def apply_fields(value, fields):
+    """Keeps only the parts of `value` selected by a parsed fields filter."""
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: apply_fields(value[key], sub) for key, sub in fields.items() if key in value}
+    return value
+
+
+def respond(body, status=200):
+    """JSON response with the request's `fields` filter applied."""
+    fields = request.args.get('fields')
+    if fields:
+        body = apply_fields(body, parse_fields(fields))
+    return jsonify(body), status
+
+
+# --- LIBRARY HELPERS ---
+
+def request_market():
+    """The request's market, with from_token resolved to the user's country."""
+    market = request.args.get('market')
+    if market == 'from_token':
+        return LIBRARY['user'].get('country')
+    return market
+
+
+def track_object(track_id, market=None):
+    """Full track object as the API returns it, with is_playable when a market is given."""
+    track = dict(LIBRARY['tracks'][track_id])
+    markets = track.pop('available_markets', None)
+    if market:
+        track['is_playable'] = markets is None or market in markets
+    track.setdefault('is_local', False)
+    return track
+
+
+def paging_limits(max_limit, default_limit):
+    limit = min(int(request.args.get('limit', default_limit)), max_limit)
+    offset = int(request.args.get('offset', 0))
+    return limit, offset
+
+
+def paging_object(items, limit, offset):
+    """Slices `items` into a Spotify paging object, with next/previous URLs."""
+    total = len(items)
+    base = request.base_url
+
+    def page_url(page_offset):
+        return f"{base}?offset={page_offset}&limit={limit}"
+
+    return {
+        'href': page_url(offset),
+        'items': items[offset:offset + limit],
+        'limit': limit,
+        'next': page_url(offset + limit) if offset + limit < total else None,
+        'offset': offset,
+        'previous': page_url(max(offset - limit, 0)) if offset > 0 else None,
+        'total': total,
+    }
+
+
+def playlist_summary(playlist_id):
+    playlist = LIBRARY['playlists'][playlist_id]
+    return {
+        'id': playlist_id,
+        'name': playlist['name'],
+        'images': playlist.get('images', []),
+        'snapshot_id': playlist['snapshot_id'],
+        'owner': {'id': LIBRARY['user'].get('id')},
+        'tracks': {'total': len(playlist['items'])},
+    }
+
+
+def playlist_items(playlist_id, market):
+    return [
+        {'added_at': '2024-01-01T00:00:00Z', 'track': track_object(track_id, market)}
+        for track_id in LIBRARY['playlists'][playlist_id]['items']
+    ]
+
+
+def new_snapshot_id():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=24))
+
+
+# --- REQUEST HOOKS (latency, 429 injection, replay, ETags) ---
+
+@fake.before_request
+def before_request():
+    with LOCK:
+        STATS['requests'] += 1
+    if OPTIONS['latency_ms']:
+        latency = OPTIONS['latency_ms'] * random.uniform(0.75, 1.25)
+        time.sleep(latency / 1000)
+
+    if request.path.startswith('/v1/') and random.random() < OPTIONS['rate_limit']:
+        with LOCK:
+            STATS['rate_limited'] += 1
+        response = jsonify({'error': {'status': 429, 'message': 'API rate limit exceeded'}})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(OPTIONS['retry_after'])
+        return response
+
+    key = (request.method, request.path, tuple(sorted(request.args.items(multi=True))))
+    with LOCK:
+        recorded = RECORDED.get(key)
+        if recorded:
+            # Serve recordings in order, repeating the last one
+            entry = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+            STATS['replayed'] += 1
+    if recorded:
+        response = jsonify(entry['body'])
+        response.status_code = entry['status']
+        for header, value in entry.get('headers', {}).items():
+            response.headers[header] = value
+        return response
+
+
+@fake.after_request
+def after_request(response):
+    """Adds an ETag to API reads and answers a matching If-None-Match with a bodiless 304."""
+    if request.method != 'GET' or not request.path.startswith('/v1/') or response.status_code != 200:
+        return response
+    if 'ETag' not in response.headers:
+        response.headers['ETag'] = '"' + hashlib.sha1(response.get_data()).hexdigest()[:20] + '"'
+    if request.headers.get('If-None-Match') == response.headers['ETag']:
+        with LOCK:
+            STATS['not_modified'] += 1
+        return fake.response_class(status=304, headers={'ETag': response.headers['ETag']})
+    return response
+
+
+# --- ACCOUNTS ENDPOINTS ---
+
+@fake.route("/authorize")
+def authorize():
+    """Skips the consent screen and sends the user straight back with a code."""
+    redirect_uri = request.args['redirect_uri']
+    state = request.args.get('state')
+    return redirect(f"{redirect_uri}?code=fake-code" + (f"&state={state}" if state else ""))
+
+
+@fake.route("/api/token", methods=["POST"])
+def token():
+    return jsonify({
+        'access_token': 'fake-access-token',
+        'token_type': 'Bearer',
+        'expires_in': 3600,
+        'refresh_token': 'fake-refresh-token',
+        'scope': request.form.get('scope', ''),
+    })
+
+
+# --- WEB API ENDPOINTS ---
+
+@fake.route("/v1/me")
+def me():
+    return respond(LIBRARY['user'])
+
+
+@fake.route("/v1/me/playlists")
+def me_playlists():
+    limit, offset = paging_limits(50, 20)
+    summaries = [playlist_summary(pid) for pid in LIBRARY['playlists']]
+    return respond(paging_object(summaries, limit, offset))
+
+
+@fake.route("/v1/me/tracks")
+def me_tracks():
+    limit, offset = paging_limits(50, 20)
+    market = request_market()
+    saved = LIBRARY['saved_tracks'][offset:offset + limit]
+    page = paging_object(LIBRARY['saved_tracks'], limit, offset)
+    page['items'] = [
+        {'added_at': entry['added_at'], 'track': track_object(entry['track'], market)}
+        for entry in saved
+    ]
+    return respond(page)
+
+
+@fake.route("/v1/tracks")
+def tracks():
+    ids = [i for i in request.args.get('ids', '').split(',') if i]
+    if len(ids) > 50:
+        return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+    market = request_market()
+    return respond({'tracks': [track_object(i, market) if i in LIBRARY['tracks'] else None for i in ids]})
+
+
+@fake.route("/v1/playlists/<playlist_id>")
+def playlist(playlist_id):
+    if playlist_id not in LIBRARY['playlists']:
+        return jsonify({'error': {'status': 404, 'message': 'Not found.'}}), 404
+    limit, offset = paging_limits(100, 100)
+    body = playlist_summary(playlist_id)
+    body['tracks'] = paging_object(playlist_items(playlist_id, request_market()), limit, offset)
+    return respond(body)
+
+
+@fake.route("/v1/playlists/<playlist_id>/tracks", methods=["GET", "DELETE"])
+@fake.route("/v1/playlists/<playlist_id>/items", methods=["GET", "DELETE"])
+def playlist_tracks(playlist_id):
+    if playlist_id not in LIBRARY['playlists']:
+        return jsonify({'error': {'status': 404, 'message': 'Not found.'}}), 404
+
+    if request.method == "DELETE":
+        payload = request.get_json(force=True, silent=True) or {}
+        uris = [entry['uri'] for entry in payload.get('tracks') or payload.get('items') or []]
+        if len(uris) > 100:
+            return jsonify({'error': {'status': 400, 'message': 'Too many tracks requested'}}), 400
+        removed_ids = {uri.split(':')[-1] for uri in uris}
+        with LOCK:
+            playlist = LIBRARY['playlists'][playlist_id]
+            playlist['items'] = [tid for tid in playlist['items'] if tid not in removed_ids]
+            playlist['snapshot_id'] = new_snapshot_id()
+            return jsonify({'snapshot_id': playlist['snapshot_id']})
+
+    limit, offset = paging_limits(100, 100)
+    return respond(paging_object(playlist_items(playlist_id, request_market()), limit, offset))
+
+
+@fake.route("/_stats")
+def stats():
+    """Request counters, for benchmarks."""
+    return jsonify(STATS)
+
+
+# --- FIXTURES ---
+
+def load_recording(path):
+    """Loads exchanges written by app.py's ExchangeRecorder (SPOTIFY_RECORD_PATH)."""
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            key = (entry['method'], entry['path'], tuple(tuple(pair) for pair in entry['query']))
+            RECORDED.setdefault(key, []).append(entry)
+
+
+def generate_library(playlist_count, tracks_per_playlist, liked_count, seed=0):
+    """
+    Generates a library with realistic overlap: playlists and Liked Songs are drawn from
+    a shared pool, and some tracks are re-releases (same title/artist, new ID and ISRC)
+    or unavailable in some markets.
+    """
+    rnd = random.Random(seed)
+    words = ["love", "night", "dance", "heart", "fire", "rain", "dream", "baby", "world", "light",
+             "time", "girl", "home", "blue", "gold", "summer", "wild", "free", "lost", "city"]
+    suffixes = ["", "", "", "", " - Remastered 2011", " (Live)", " - Radio Edit", " (feat. Someone)"]
+    artists = [{'id': f"artist{i:05d}", 'name': f"Artist {i}"} for i in range(max(50, playlist_count * tracks_per_playlist // 20))]
+
+    track_ids = []
+    pool_size = max(1, int((playlist_count * tracks_per_playlist + liked_count) * 0.6))
+    originals = []
+    for i in range(pool_size):
+        if originals and rnd.random() < 0.1:
+            # A re-release of an earlier track
+            original = rnd.choice(originals)
+            name = original['name'].split(' - ')[0].split(' (')[0] + rnd.choice(suffixes)
+            track_artists = original['artists']
+            duration = original['duration_ms'] + rnd.randint(-4000, 4000)
+        else:
+            name = ' '.join(rnd.sample(words, rnd.randint(1, 3))).title() + rnd.choice(suffixes)
+            track_artists = rnd.sample(artists, 1 if rnd.random() < 0.8 else 2)
+            duration = rnd.randint(120000, 320000)
+        track = {
+            'id': f"track{i:07d}",
+            'name': name,
+            'duration_ms': duration,
+            'artists': track_artists,
+            'external_ids': {'isrc': f"XX{i:010d}"},
+            'type': 'track',
+            'uri': f"spotify:track:track{i:07d}",
+        }
+        if rnd.random() < 0.02:
+            track['available_markets'] = ['US']
+        LIBRARY['tracks'][track['id']] = track
+        track_ids.append(track['id'])
+        originals.append(track)
+
+    LIBRARY['user'] = {'id': 'fake-user', 'display_name': 'Fake User', 'country': 'AU'}
+    for p in range(playlist_count):
+        LIBRARY['playlists'][f"playlist{p:05d}"] = {
+            'name': f"Playlist {p}",
+            'images': [],
+            'snapshot_id': new_snapshot_id(),
+            'items': [rnd.choice(track_ids) for _ in range(tracks_per_playlist)],
+        }
+    liked = rnd.sample(track_ids, min(liked_count, len(track_ids)))
+    LIBRARY['saved_tracks'] = [
+        {'added_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(1700000000 - i * 3600)), 'track': track_id}
+        for i, track_id in enumerate(liked)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Spotify Web API.")
+    parser.add_argument("--port", type=int, default=8888)
+    parser.add_argument("--library")
+    parser.add_argument("--generate", default="10x500")
+    parser.add_argument("--liked", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--replay")
+    parser.add_argument("--save-library")
+    args = parser.parse_args()
+
+    if args.library:
+        with open(args.library) as f:
+            LIBRARY.update(json.load(f))
+    else:
+        playlist_count, tracks_per_playlist = (int(n) for n in args.generate.split('x'))
+        generate_library(playlist_count, tracks_per_playlist, args.liked, args.seed)
+    if args.save_library:
+        with open(args.save_library, 'w') as f:
+            json.dump(LIBRARY, f)
+    if args.replay:
+        load_recording(args.replay)
+
+    OPTIONS.update(latency_ms=args.latency_ms, rate_limit=args.rate_limit, retry_after=args.retry_after)
+    random.seed(args.seed)
+    print(f"Serving {len(LIBRARY['playlists'])} playlists, {len(LIBRARY['tracks'])} tracks, "
+          f"{len(LIBRARY['saved_tracks'])} liked songs on port {args.port}")
+    fake.run(port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+Serves fake_spotify.py on a local port for the whole test session, and points app.py at it
+before app.py is imported (it reads its settings at import time).
+"""
+import os
+import socket
+import sys
+import threading
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    FAKE_PORT = probe.getsockname()[1]
+
+os.environ.update(
+    CLIENT_ID="test-client",
+    CLIENT_SECRET="test-secret",
+    REDIRECT_URI="http://localhost/callback",
+    FLASK_SECRET_KEY="test-secret-key",
+    SPOTIFY_API_URL=f"http://127.0.0.1:{FAKE_PORT}/v1/",
+    SPOTIFY_ACCOUNTS_URL=f"http://127.0.0.1:{FAKE_PORT}",
+)
+
+import fake_spotify  # noqa: E402
+
+fake_spotify.generate_library(playlist_count=3, tracks_per_playlist=50, liked_count=100)
+FAKE_SERVER = make_server("127.0.0.1", FAKE_PORT, fake_spotify.fake, threaded=True)
+threading.Thread(target=FAKE_SERVER.serve_forever, daemon=True).start()
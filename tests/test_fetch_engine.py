@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+class PagedSource:
+    """A paged endpoint of `total` numbered items that records when each offset was requested."""
+
+    def __init__(self, total, delay=0.0):
+        self.total = total
+        self.delay = delay
+        self.requested_at = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, limit, offset):
+        with self.lock:
+            self.requested_at[offset] = time.monotonic()
+        time.sleep(self.delay)
+        return {'items': list(range(offset, min(offset + limit, self.total))), 'total': self.total}
+
+
+def test_pages_keep_coming_while_the_caller_works_between_results():
+    fast, slow = PagedSource(10), PagedSource(30, delay=0.1)
+    results = app.fetch_pages_concurrently([(fast, 10), (slow, 10)])
+
+    assert next(results) == (0, list(range(10)))
+    busy_until = time.monotonic() + 0.5
+    time.sleep(0.5)  # The slow source's first page arrives meanwhile, and its other pages are requested
+
+    assert next(results) == (1, list(range(30)))
+    assert max(slow.requested_at.values()) < busy_until
+    assert list(results) == []
+
+
+def test_errors_reach_the_caller():
+    def failing_page(limit, offset):
+        raise ValueError("page failed")
+
+    with pytest.raises(ValueError, match="page failed"):
+        next(app.fetch_pages_concurrently([(failing_page, 10)]))
@@ -0,0 +1,71 @@
+import os
+import threading
+
+import app
+
+
+def track(track_id, name, duration_ms, artist_ids, isrc=None):
+    return {
+        'id': track_id,
+        'name': name,
+        'duration_ms': duration_ms,
+        'artists': [{'id': artist_id, 'name': artist_id} for artist_id in artist_ids],
+        'external_ids': {'isrc': isrc} if isrc else {},
+    }
+
+
+FILTER_TRACKS = [
+    track('f1', 'Blue Night - Remastered 2011', 200000, ['a1'], 'ISRC1'),
+    track('f2', 'Golden Hour (Live)', 180000, ['a2']),
+    track('f3', 'Golden Hours', 181000, ['a2', 'a3']),
+    track('f4', '', 150000, ['a4'], 'ISRC4'),
+    track('f5', 'Summer Rain', 240000, ['a5']),
+]
+TARGET_TRACKS = [
+    track('t1', 'Blue Night', 201000, ['a1']),
+    track('t2', 'Golden Hour', 180500, ['a2']),
+    track('t3', 'Something Else', 100000, ['a9'], 'ISRC4'),
+    track('t4', 'Summer Rains', 239000, ['a6']),
+]
+
+
+def summary(result):
+    duplicates, warnings = result
+    return [[(t['id'], f['id'], score, reasons) for t, f, score, reasons in found] for found in (duplicates, warnings)]
+
+
+def test_mapped_index_matches_like_the_built_one(tmp_path):
+    path = str(tmp_path / "corpus.idx")
+    built = app.build_filter_index(FILTER_TRACKS, "python")
+    app.save_filter_index(built, path)
+
+    mapped = app.open_filter_index(path, "python")
+
+    assert isinstance(mapped, app.MappedFilterIndex)
+    expected = summary(app.find_duplicates_and_warnings(TARGET_TRACKS, FILTER_TRACKS, filter_index=built))
+    assert summary(app.find_duplicates_and_warnings(TARGET_TRACKS, FILTER_TRACKS, filter_index=mapped)) == expected
+
+
+def test_truncated_index_file_is_rejected_when_opened(tmp_path):
+    path = str(tmp_path / "corpus.idx")
+    app.save_filter_index(app.build_filter_index(FILTER_TRACKS, "python"), path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-8])  # Only the last track is cut short, everything else still parses
+
+    assert app.open_filter_index(path, "python") is None
+
+
+def test_concurrent_saves_leave_one_complete_file(tmp_path):
+    path = str(tmp_path / "corpus.idx")
+    built = app.build_filter_index(FILTER_TRACKS, "python")
+
+    threads = [threading.Thread(target=app.save_filter_index, args=(built, path)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(tmp_path) == ["corpus.idx"]
+    assert app.open_filter_index(path, "python") is not None
@@ -0,0 +1,87 @@
+import gc
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+
+
+def logged_in_client():
+    client = app.app.test_client()
+    client.get("/login")
+    client.get("/callback?code=fake-code")
+    return client
+
+
+def api_pool():
+    """The urllib3 connection pool HTTP_SESSION uses for the Spotify API."""
+    adapter = app.HTTP_SESSION.get_adapter(app.SPOTIFY_API_URL)
+    return adapter.poolmanager.connection_from_url(app.SPOTIFY_API_URL)
+
+
+def test_clients_going_away_keep_the_shared_session_open():
+    client = logged_in_client()
+    assert client.get("/").status_code == 200
+    gc.collect()  # spotipy clients and OAuth managers close their session in __del__
+    pool = api_pool()
+    connections = pool.num_connections
+
+    assert client.get("/").status_code == 200
+    gc.collect()
+
+    assert api_pool() is pool
+    assert pool.num_connections == connections
+
+
+class CookieSettingHandler(BaseHTTPRequestHandler):
+    """Sets a cookie on every response and records the Cookie header each request came with."""
+    cookies_received = []
+
+    def do_GET(self):
+        self.cookies_received.append(self.headers.get('Cookie'))
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'sp_t=first-user; Path=/')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cookies_from_one_users_response_are_not_sent_with_the_next():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CookieSettingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/me"
+    http = app.SpotifySession(app.RATE_LIMITER)
+    try:
+        http.get(url, headers={'Authorization': 'Bearer first-user'})
+        http.get(url, headers={'Authorization': 'Bearer second-user'})
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert CookieSettingHandler.cookies_received == [None, None]
+    assert len(http.cookies) == 0
+
+
+def test_per_user_responses_are_revalidated_after_a_token_refresh():
+    http = app.SpotifySession(app.RATE_LIMITER, response_cache=app.MemoryCache(10 ** 7))
+    playlists_url = app.SPOTIFY_API_URL + "me/playlists"
+
+    for token in ("first-token", "refreshed-token"):
+        headers = {'Authorization': f"Bearer {token}"}
+        assert http.get(app.SPOTIFY_API_URL + "me", headers=headers).status_code == 200
+        assert http.get(playlists_url, headers=headers, params={'limit': 50}).status_code == 200
+
+    # The refreshed token belongs to the same user, so the playlist page cached under the first one is reused
+    assert http.cache_stats == {'conditional': 1, 'not_modified': 1}
+
+
+def test_per_user_responses_are_not_cached_before_the_user_is_known():
+    http = app.SpotifySession(app.RATE_LIMITER, response_cache=app.MemoryCache(10 ** 7))
+    headers = {'Authorization': "Bearer unknown-token"}
+
+    for _ in range(2):
+        assert http.get(app.SPOTIFY_API_URL + "me/playlists", headers=headers).status_code == 200
+
+    assert http.cache_stats == {'conditional': 0, 'not_modified': 0}
@@ -0,0 +1,30 @@
+import app
+
+
+class PlaylistsClient:
+    """Stands in for spotipy: lists one page of playlists with whatever snapshot_ids are set."""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    def current_user_playlists(self, limit=50, offset=0):
+        items = [{'id': pid, 'name': pid, 'images': [], 'snapshot_id': snapshot, 'tracks': {'total': 1}}
+                 for pid, snapshot in self.snapshots.items()]
+        return {'items': items[offset:offset + limit], 'total': len(items), 'next': None}
+
+    def playlist(self, pid, fields=None):
+        return {'snapshot_id': self.snapshots[pid]}
+
+
+def test_snapshot_ids_see_an_edit_made_within_the_listing_ttl(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "LIBRARY_MIRROR_TTL", 3600)
+    mirror = app.LibraryMirror(str(tmp_path / "mirror.sqlite"))
+    sp = PlaylistsClient({'p1': 's1', 'p2': 's1'})
+    assert mirror.sync_playlists(sp, 'user')
+
+    # The playlist list page still uses the listing from a moment ago...
+    sp.snapshots['p1'] = 's2'
+    assert not mirror.sync_playlists(sp, 'user')
+
+    # ...but a run matches against what the filter playlists contain now
+    assert mirror.snapshot_ids(sp, 'user', ['p1', 'p2']) == ['s2', 's1']
@@ -0,0 +1,40 @@
+import app
+
+
+class SavedTracksClient:
+    """Stands in for spotipy's current_user_saved_tracks, recording the offset of every page fetched."""
+
+    def __init__(self, count):
+        self.items = [{'added_at': f"2024-01-01T00:{999 - i:03d}Z", 'track': {'id': f"t{i}", 'name': f"Song {i}"}}
+                      for i in range(count)]
+        self.offsets = []
+
+    def current_user_saved_tracks(self, limit=20, offset=0):
+        self.offsets.append(offset)
+        return {'items': self.items[offset:offset + limit], 'total': len(self.items)}
+
+
+class CountingCache(app.MemoryCache):
+    sets = 0
+
+    def set(self, key, value, weight=1):
+        self.sets += 1
+        super().set(key, value, weight)
+
+
+def test_sync_fetches_each_page_once_and_skips_unchanged_saves(monkeypatch):
+    cache = CountingCache(10000)
+    monkeypatch.setattr(app, "PLAYLIST_CACHE", cache)
+    monkeypatch.setattr(app, "LIBRARY_MIRROR", None)
+    sp = SavedTracksClient(120)
+
+    # Cold: the first page isn't fetched a second time for the full sync
+    assert [t['id'] for t in app.sync_liked_songs(sp, 'user')] == [f"t{i}" for i in range(120)]
+    assert sorted(sp.offsets) == [0, 50, 100]
+    assert cache.sets == 1
+
+    # Nothing changed: one page to find the watermark, and the cached mirror isn't rewritten
+    sp.offsets = []
+    assert len(app.sync_liked_songs(sp, 'user')) == 120
+    assert sp.offsets == [0]
+    assert cache.sets == 1
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_scheduler(max_retry_after):
+    return app.RateLimitScheduler(
+        global_rate=1000, global_burst=1000, user_rate=1000, user_burst=1000,
+        initial_concurrency=4, max_concurrency=4, max_retry_after=max_retry_after, max_retries=3,
+    )
+
+
+def test_long_retry_after_is_returned_and_pauses_others_at_most_max_retry_after():
+    scheduler = make_scheduler(max_retry_after=0.2)
+
+    response = scheduler.send("user-a", lambda: FakeResponse(429, {"Retry-After": "600"}))
+    assert response.status_code == 429
+
+    # Another user's request goes out once max_retry_after has passed, not after 600s
+    responses = []
+    other = threading.Thread(target=lambda: responses.append(scheduler.send("user-b", lambda: FakeResponse(200))), daemon=True)
+    other.start()
+    other.join(timeout=2)
+    assert [response.status_code for response in responses] == [200]
+
+
+def test_short_retry_after_is_waited_out_and_retried():
+    scheduler = make_scheduler(max_retry_after=5)
+    responses = iter([FakeResponse(429, {"Retry-After": "0"}), FakeResponse(200)])
+
+    assert scheduler.send("user-a", lambda: next(responses)).status_code == 200
+    assert scheduler.stats["retried"] == 1
+
+
+def test_buckets_turned_off_never_hold_a_request_back():
+    scheduler = app.RateLimitScheduler(
+        global_rate=0, global_burst=1, user_rate=0, user_burst=1,
+        initial_concurrency=4, max_concurrency=4, max_retry_after=5, max_retries=3,
+    )
+
+    # With a burst of 1 at any real rate, the second of these would already have to wait
+    started = time.monotonic()
+    for _ in range(200):
+        assert scheduler.send("user-a", lambda: FakeResponse(200)).status_code == 200
+    assert time.monotonic() - started < 1
@@ -0,0 +1,31 @@
+import json
+import os
+
+import app
+
+
+def saved_titles(path):
+    with open(path) as f:
+        return dict(json.load(f)['titles'])
+
+
+def test_saves_are_throttled_until_forced(tmp_path, monkeypatch):
+    path = str(tmp_path / "titles.json")
+    monkeypatch.setattr(app, "TITLE_CACHE", app.MemoryCache(100))
+    monkeypatch.setattr(app, "TITLE_CACHE_SAVE_INTERVAL", 3600)
+    monkeypatch.setattr(app, "_title_cache_saved_misses", 0)
+    monkeypatch.setattr(app, "_title_cache_saved_at", None)
+
+    app.normalize_title("Blue Night - Remastered 2011")
+    app.save_title_cache(path)
+    assert saved_titles(path) == {"Blue Night - Remastered 2011": "blue night"}
+
+    # A new title right after a save waits for the interval...
+    app.normalize_title("Golden Hour (Live)")
+    app.save_title_cache(path)
+    assert "Golden Hour (Live)" not in saved_titles(path)
+
+    # ...or for a forced save, as at exit
+    app.save_title_cache(path, force=True)
+    assert saved_titles(path)["Golden Hour (Live)"] == "golden hour"
+    assert os.listdir(tmp_path) == ["titles.json"]
@@ -0,0 +1,128 @@
+"""
+app._normalize_title skips rules whose `needs` text isn't in the title (see TITLE_VERSION_RULES).
+These tests check it against the original normalizer, which ran every rule with re.sub on every
+title, so a wrong or missing `needs` entry shows up as a difference.
+"""
+import random
+import re
+
+import app
+
+# The original normalizer, frozen: the reference output. Don't update it along with app.py.
+REFERENCE_VERSION_PATTERNS = [
+    # Specific remaster/re-recorded patterns first
+    r'\s*[-–—]\s*re-?recorded.*$',  # " - Re-Recorded" at end
+    r'\s*\(remastered\s+album\s+version\)',
+    r'\s*\(remastered\s+\d+\)',
+    r'\s*\(remaster(ed)?\s*\d*\)',
+    r'\s*[-–—]\s*remaster(ed)?(\s+\d+)?(\s+album\s+version)?',
+    r'\s*[-–—]\s*\d+\s*remaster(ed)?',
+    r'\s*\(remaster(ed)?(\s+\d+)?(\s+album\s+version)?\)',
+    r'\s*\(\d+\s*remaster(ed)?\)',
+    # Album/version indicators
+    r'\s*\(deluxe.*?\)',
+    r'\s*\(expanded.*?\)',
+    r'\s*\(anniversary.*?\)',
+    r'\s*\(bonus track.*?\)',
+    r'\s*\(album version.*?\)',
+    r'\s*\(original.*?\)',
+    r'\s*\(single version.*?\)',
+    r'\s*\(radio edit.*?\)',
+    r'\s*\(explicit.*?\)',
+    r'\s*\(clean.*?\)',
+    r'\s*\(edit\)',
+    r'\s*\(re-?recorded.*?\)',
+    r'\s*\(remix.*?\)',
+    r'\s*[-–—]\s*remix.*$',
+    r'\s*[-–—]\s*live.*$',
+    r'\s*\(live.*?\)',
+    r'\s*\(acoustic.*?\)',
+    r'\s*[-–—]\s*acoustic.*$',
+    r'\s*[-–—]\s*from\s+".*"',
+    r'\s*\(from\s+".*"\)',
+    r'\s*\(from\s+.*?\)',
+    r'\s*[-–—]\s*mono.*$',
+    r'\s*\(mono.*?\)',
+    r'\s*[-–—]\s*stereo.*$',
+    r'\s*\(stereo.*?\)',
+    r'\s*\(super\s+deluxe.*?\)',
+    r'\s*\(special\s+edition.*?\)',
+    r'\s*\(version\)$',
+    # Generic catch-alls LAST
+    r'\s*\([^)]*remaster[^)]*\)',  # Anything with remaster in parens
+    r'\s*\([^)]*version\)',  # Anything ending with version in parens
+    r'\s*\([^)]*edition\)',  # Anything ending with edition in parens
+    r'\s*\([^)]*mix\)',  # Anything ending with mix in parens
+]
+
+
+def reference_normalize_title(title):
+    if not title:
+        return ""
+    title = title.lower()
+    for pattern in REFERENCE_VERSION_PATTERNS:
+        title = re.sub(pattern, '', title, flags=re.IGNORECASE)
+    title = re.sub(r'\s*(feat\.?|ft\.?|featuring)\s+.*$', '', title, flags=re.IGNORECASE)
+    title = re.sub(r'\s*\((feat\.?|ft\.?|featuring).*?\)', '', title, flags=re.IGNORECASE)
+    title = ' '.join(title.split())
+    return title.strip()
+
+
+# Every rule keyword, bracket and dash style, whitespace, and letters that only match under
+# IGNORECASE after lowercasing (ſ matches s, İ lowercases to i plus a combining dot, K is the Kelvin sign)
+FUZZ_TOKENS = [
+    "(", ")", " (", ") ", " - ", " – ", " — ", "-", "remaster", "remastered", "ed", "2011", " 2011",
+    "album", " album ", "version", "deluxe", "live", "feat.", "feat", " ft. ", "ft", "featuring", '"',
+    "from ", "mono", "stereo", "mix", "remix", "edition", "re-recorded", "rerecorded", "recorded",
+    "super ", "special ", "edit", "radio edit", "clean", "explicit", "original", "bonus track",
+    "acoustic", "anniversary", "expanded", "single version", " ", "  ", "\t", "x", "ſ", "İ", "K", "ı",
+    "Love", "Song", "Taylor's Version", "é", "7 rings", "soft", "after",
+]
+REAL_TITLES = [
+    "Shake It Off", "Bohemian Rhapsody", "Hey Jude", "7 rings", "Blinding Lights", "Love Story",
+    "Señorita", "Straße", "Don't Stop Me Now", "Mr. Brightside", "Here Comes the Sun", "Fix You",
+]
+REAL_SUFFIXES = [
+    " - Remastered 2011", " (Remastered 2009)", " (Taylor's Version)", " (feat. Drake)",
+    " - Live at Wembley", " (Live)", ' - From "Frozen"', ' (From "Frozen")', " - Radio Edit",
+    " (2015 Remaster)", " (Deluxe Edition)", " - Mono Version", " (Remastered Album Version)",
+    " - 2011 Remaster", " (Original Mix)", " (Club Mix)", " ft. Someone", " - Acoustic",
+    " (Super Deluxe)", " (Version)", " [Bonus]", " - Re-Recorded", " - Stereo", " (Edit)",
+]
+
+
+def fuzzed_titles(count, seed=12):
+    rnd = random.Random(seed)
+    for _ in range(count):
+        title = ''.join(rnd.choice(FUZZ_TOKENS) for _ in range(rnd.randint(1, 12)))
+        yield ''.join(c.upper() if rnd.random() < 0.3 else c for c in title)
+
+
+def suffixed_titles():
+    for title in REAL_TITLES:
+        for first in REAL_SUFFIXES:
+            yield title + first
+            for second in REAL_SUFFIXES:
+                yield title + first + second
+
+
+def mismatches(titles):
+    return [(title, app._normalize_title(title), reference_normalize_title(title))
+            for title in titles if app._normalize_title(title) != reference_normalize_title(title)]
+
+
+def test_matches_the_reference_on_fuzzed_titles():
+    assert mismatches(fuzzed_titles(200000)) == []
+
+
+def test_matches_the_reference_on_suffixed_real_titles():
+    assert mismatches(suffixed_titles()) == []
+
+
+def test_matches_the_reference_on_case_folding_letters():
+    titles = [
+        "Miſs You (Remaſtered 2011)", "Miss You - REMAſTERED", "Song (ſtereo)", "Song - Liſe",
+        "Song (İnstrumental Mix)", "Song - LİVE", "Song (Exİt Edİtİon)", "Song fİt. Someone",
+        "Song (K Mix)", "Song - Mono (Live)", "Song (ſuper Deluxe)", "Song ſt. Someone",
+    ]
+    assert mismatches(titles) == []